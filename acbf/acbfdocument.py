@@ -19,33 +19,94 @@ https://github.com/ACBF-Advanced-Comic-Book-Format
 # -------------------------------------------------------------------------
 
 import os.path
+import mmap
 import shutil
+import threading
+from collections import OrderedDict
 import lxml.etree as xml
 from lxml import objectify
 import base64
 from PIL import Image
-from xml.sax.saxutils import escape
-import io
-import urllib.request, urllib.parse, urllib.error
+from xml.sax.saxutils import escape, unescape
 import re
-import zipfile
+import pickle
+import hashlib
+from array import array
 
 try:
   from . import constants
+  from . import archive
+  from . import bookcache
 except Exception:
   import constants
+  import archive
+  import bookcache
+
+# binary elements are found in raw document, their content never gets to parser
+BINARY_START = re.compile(rb'<(?:[\w.-]+:)?binary\b([^>]*)>')
+BINARY_END = re.compile(rb'</(?:[\w.-]+:)?binary\s*>')
+XML_ATTRIBUTE = re.compile(rb'([\w:.-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+# style flags of text runs
+RUN_EMPHASIS = 1
+RUN_STRONG = 2
+RUN_CODE = 4
+RUN_SUP = 8
+RUN_SUB = 16
+RUN_STRIKETHROUGH = 32
+RUN_INVERTED = 64
+RUN_COMMENTARY = 128
+RUN_STYLES = {'emphasis': RUN_EMPHASIS, 'strong': RUN_STRONG, 'code': RUN_CODE, 'sup': RUN_SUP, 'sub': RUN_SUB,
+              'strikethrough': RUN_STRIKETHROUGH, 'inverted': RUN_INVERTED, 'commentary': RUN_COMMENTARY}
+# line breaks and indentation inside paragraph are single spaces
+WHITESPACE = re.compile(r'\s+')
+# stylesheet tokens: comments, quoted strings, block and declaration delimiters, anything else
+CSS_TOKEN = re.compile(r'/\*.*?(?:\*/|$)|"(?:\\.|[^"\\])*"?|\'(?:\\.|[^\'\\])*\'?|[{};]|[^{};"\'/]+|/', re.S)
+CSS_ATTRIBUTE = re.compile(r'\[\s*([\w-]+)\s*=\s*["\']?([^"\'\]]*?)["\']?\s*\]')
+CSS_IMPORTANT = re.compile(r'\s*!\s*important\s*$', re.I)
+# font style -> selectors setting it, later ones win
+FONT_SELECTORS = (('normal', ('text-area', 'p')), ('emphasis', ('emphasis',)), ('strong', ('strong',)),
+                  ('code', ('code', 'text-area[type=code]')), ('commentary', ('commentary', 'text-area[type=commentary]')),
+                  ('sign', ('text-area[type=sign]',)), ('formal', ('text-area[type=formal]',)), ('heading', ('text-area[type=heading]',)),
+                  ('letter', ('text-area[type=letter]',)), ('audio', ('text-area[type=audio]',)), ('thought', ('text-area[type=thought]',)))
+# parser is fed by chunks of this size
+FEED_SIZE = 64 * 1024
+# space for decoded embedded images of one book
+BINARY_CACHE_SIZE = 64 * 1024 * 1024
+# directory of book directory they are decoded into
+BINARY_DIR = 'Binaries'
+# extension kept on decoded binary file, so image loaders recognise it
+BINARY_EXTENSION = re.compile(r'^\.\w+$')
+# bumped whenever parsed document model changes, older snapshots are ignored
+SNAPSHOT_VERSION = '4'
+# snapshots kept at most, least recently used are removed
+SNAPSHOT_LIMIT = 200
+# parsed document state kept in snapshot
+SNAPSHOT_ATTRIBUTES = ('coverpage_uri', 'pages_total', 'bg_color', 'authors', 'genres', 'keywords', 'characters', 'databaseref',
+                       'publisher', 'publish_date', 'city', 'isbn', 'license', 'publish_date_value', 'doc_authors',
+                       'creation_date', 'source', 'id', 'version', 'history', 'languages', 'contents_table', 'sequences',
+                       'book_title', 'annotation', 'genres_dict', 'has_frames', 'font_styles', 'font_colors', 'pages',
+                       'frame_coords', 'frame_starts', 'frame_colors', 'page_frames', 'reference_texts', 'binary_ranges', 'styles')
 
 class ACBFDocument():
 
     def __init__(self, window,
-                       filename):
+                       filename, source=None, probe=False, tree=None, snapshot_dir=None):
+        # source is file object to parse instead of filename, tree is document
+        # built in memory, when probing metadata nothing is written to disk;
+        # parsed document is kept in snapshot_dir and loaded from there next time
         self._window = window
+        self.probe = probe
         self.coverpage = None
+        self.coverpage_uri = None
         self.cover_thumb = None
         self.pages_total = 0
         self.bg_color = '#000000'
         self.valid = False
         self.filename = filename
+        self.data = None
+        self.binaries = {}
+        self.binary_ranges = {}
+        self.snapshot_path = None
         self.authors = self.genres = self.keywords = self.characters = self.databaseref = ''
         self.publisher = self.publish_date = self.city = self.isbn = self.license = self.publish_date_value = ''
         self.doc_authors = self.creation_date = self.source = self.id = self.version = self.history = ''
@@ -53,7 +114,11 @@ class ACBFDocument():
         self.contents_table = self.sequences = []
         self.book_title = self.annotation = self.genres_dict = {}
         self.has_frames = False
-        self.fonts_dir = os.path.join(self._window.tempdir, 'Fonts')
+        self.styles = {}
+        self.text_areas = {}
+        self.text_lock = threading.Lock()
+        self.text_thread = None
+        self.fonts_dir = os.path.join(self._window.book_dir, 'Fonts')
         self.font_styles = {'normal': '', 'emphasis': '', 'strong': '', 'code': '', 'commentary': '', 'sign': '', 'formal': '', 'heading': '', 'letter': '', 'audio': '', 'thought': ''}
         self.font_colors = {'inverted': '#FFFFFF', 'speech': '#000000', 'code': '#000000', 'commentary': '#000000', 'sign': '#000000', 'formal': '#000000', 'heading': '#000000', 'letter': '#000000', 'audio': '#000000', 'thought': '#000000'}
         for style in ['normal', 'emphasis', 'strong', 'code', 'commentary', 'sign', 'formal', 'heading', 'letter', 'audio', 'thought']:
@@ -61,14 +126,32 @@ class ACBFDocument():
         
         try:
             self.base_dir = os.path.dirname(filename)
-            self.tree = xml.parse(source = filename)
-            root = self.tree.getroot()
-
-            for elem in root.getiterator():
-              i = elem.tag.find('}')
-              if i >= 0:
-                elem.tag = elem.tag[i+1:]
-            objectify.deannotate(root)
+            if tree is not None:
+              # built without namespaces, nothing to strip
+              self.tree = tree
+            else:
+              if source is None:
+                # mapped, embedded binaries are read from it when needed
+                with open(filename, 'rb') as f:
+                  self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+              else:
+                self.data = source.read()
+              if snapshot_dir is not None:
+                self.snapshot_path = os.path.join(snapshot_dir, self.get_snapshot_key(source is None) + '.pickle')
+                if self.load_snapshot():
+                  self.valid = True
+                  return
+              self.tree = self.parse_document(self.data)
+              root = self.tree
+
+              for elem in root.iter():
+                i = elem.tag.find('}')
+                if i >= 0:
+                  elem.tag = elem.tag[i+1:]
+              objectify.deannotate(root)
+              # declaration of default namespace would come back with text layers
+              # serialised into snapshot and hide them from findall
+              xml.cleanup_namespaces(root)
 
             #print(xml.tostring(self.tree, encoding='unicode', pretty_print=True))
             self.bookinfo = self.tree.find("meta-data/book-info")
@@ -78,22 +161,144 @@ class ACBFDocument():
             self.bg_color = self.tree.find("body").get("bgcolor")
             if self.bg_color == None:
               self.bg_color = '#000000'
-            self.pages = self.tree.findall("body/" + "page")
-            self.pages_total = len(self.pages)
-            self.binaries = self.tree.findall("data/" + "binary")
+            self.compile_body()
+            # binaries the scan did not find are indexed from tree
+            for binary in self.tree.findall("data/" + "binary"):
+              self.binaries[binary.get("id")] = (binary.get("content-type"), binary.text)
+              binary.getparent().remove(binary)
+            self.binary_cache = BinaryCache(self.binaries, os.path.join(self._window.book_dir, BINARY_DIR), BINARY_CACHE_SIZE)
             self.load_metadata()
             self.get_contents_table()
-            self.extract_fonts()
+            if not self.probe:
+              self.extract_fonts()
             self.stylesheet = self.tree.find("style")
             if self.stylesheet != None:
               self.load_stylesheet()
             self.tree = None # keep memory usage low
+            self.bookinfo = self.publishinfo = self.docinfo = self.references = self.stylesheet = None
+            if self.snapshot_path is not None:
+              self.save_snapshot()
             self.valid = True
         except Exception as inst:
             print("Unable to open ACBF file: %s %s" % (filename, inst))
             self.valid = False
             return
 
+    def close(self):
+        # binaries are views of mapped document, map is closed once they are released
+        binaries = list(self.binaries.values())
+        self.binaries.clear()
+        self.binary_ranges = {}
+        try:
+          for content_type, binary_data in binaries:
+            if isinstance(binary_data, memoryview):
+              binary_data.release()
+          if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        except BufferError:
+          # binary is being decoded by other thread, map goes away with its last view
+          pass
+        self.data = None
+
+    def parse_document(self, data):
+        # parser gets document without content of binary elements, those are
+        # indexed as id -> (content-type, base64 data left in place)
+        parser = xml.XMLPullParser(events=(), huge_tree=True)
+        pos = 0
+        while True:
+          start = BINARY_START.search(data, pos)
+          if start is None:
+            break
+          if start.group(1).rstrip().endswith(b'/'):
+            self.feed_parser(parser, data, pos, start.end())
+            pos = start.end()
+            continue
+          end = BINARY_END.search(data, start.end())
+          if end is None:
+            break
+          self.feed_parser(parser, data, pos, start.start())
+          attributes = {}
+          for name, value, value2 in XML_ATTRIBUTE.findall(start.group(1)):
+            attributes[name.decode('utf-8')] = unescape((value or value2).decode('utf-8'))
+          self.binaries[attributes.get("id")] = (attributes.get("content-type"), memoryview(data)[start.end():end.start()])
+          self.binary_ranges[attributes.get("id")] = (attributes.get("content-type"), start.end(), end.start())
+          pos = end.end()
+        self.feed_parser(parser, data, pos, len(data))
+        return parser.close()
+
+    def feed_parser(self, parser, data, start, end):
+        for pos in range(start, end, FEED_SIZE):
+          parser.feed(data[pos:min(pos + FEED_SIZE, end)])
+
+    def get_snapshot_key(self, on_disk):
+        # document on disk is known by path, size and modification time like
+        # archive index, document read from archive by its content; font styles
+        # are paths into fonts directory and probe does not extract fonts
+        if on_disk:
+          stat = os.stat(self.filename)
+          key = '%s:%d:%d' % (os.path.abspath(self.filename), stat.st_size, stat.st_mtime_ns)
+        else:
+          key = bookcache.get_data_fingerprint(self.data)
+        key = '\n'.join([key, os.path.abspath(self.base_dir), os.path.abspath(self.fonts_dir), str(self.probe)])
+        return hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest()
+
+    def save_snapshot(self):
+        # text layers not compiled yet are kept as xml, binaries as ranges of document
+        state = {}
+        with self.text_lock:
+          for page in self.pages:
+            for language, text_layers in page.text_layers.items():
+              page.text_layers[language] = [text_layer if isinstance(text_layer, bytes) else xml.tostring(text_layer, with_tail=False)
+                                            for text_layer in text_layers]
+          for name in SNAPSHOT_ATTRIBUTES:
+            state[name] = getattr(self, name)
+          state['text_areas'] = dict(self.text_areas)
+        state['binary_texts'] = {}
+        for binary_id, (content_type, binary_data) in self.binaries.items():
+          if binary_id not in self.binary_ranges:
+            state['binary_texts'][binary_id] = (content_type, binary_data)
+
+        try:
+          snapshot_dir = os.path.dirname(self.snapshot_path)
+          if not os.path.exists(snapshot_dir):
+            os.makedirs(snapshot_dir, 0o700)
+          # books are probed in parallel, each writer has its own part file
+          part_file = self.snapshot_path + '.' + str(threading.get_ident()) + '.part'
+          f = open(part_file, 'wb')
+          pickle.dump((SNAPSHOT_VERSION, state), f, pickle.HIGHEST_PROTOCOL)
+          f.close()
+          os.replace(part_file, self.snapshot_path)
+          prune_snapshots(snapshot_dir)
+        except Exception as inst:
+          print("Unable to save document snapshot: %s" % inst)
+
+    def load_snapshot(self):
+        if not os.path.isfile(self.snapshot_path):
+          return False
+        try:
+          with open(self.snapshot_path, 'rb') as f:
+            version, state = pickle.load(f)
+        except Exception as inst:
+          print("Unable to read document snapshot: %s" % inst)
+          return False
+        if version != SNAPSHOT_VERSION:
+          return False
+
+        for name in SNAPSHOT_ATTRIBUTES:
+          setattr(self, name, state[name])
+        self.tree = self.bookinfo = self.publishinfo = self.docinfo = self.references = self.stylesheet = None
+        self.text_areas = state['text_areas']
+        self.binaries = state['binary_texts']
+        for binary_id, (content_type, start, end) in self.binary_ranges.items():
+          self.binaries[binary_id] = (content_type, memoryview(self.data)[start:end])
+        self.binary_cache = BinaryCache(self.binaries, os.path.join(self._window.book_dir, BINARY_DIR), BINARY_CACHE_SIZE)
+        if not self.probe:
+          self.coverpage = self.load_image(self.coverpage_uri)
+          self.extract_fonts()
+        # recently used snapshots are kept when there are too many
+        os.utime(self.snapshot_path, None)
+        return True
+
     def load_metadata(self):
         self.authors = self.genres = self.keywords = self.characters = self.databaseref = ''
         self.publisher = self.publish_date = self.city = self.isbn = self.license = self.publish_date_value = ''
@@ -104,8 +309,9 @@ class ACBFDocument():
 
         # get coverpage
         image_id = self.bookinfo.find("coverpage/" + "image").get("href")
-        image_uri = ImageURI(image_id)
-        self.coverpage = self.load_image(image_uri)
+        self.coverpage_uri = ImageURI(image_id)
+        if not self.probe:
+          self.coverpage = self.load_image(self.coverpage_uri)
         
         # get authors
         for author in self.bookinfo.findall("author"):
@@ -234,27 +440,136 @@ class ACBFDocument():
             self.history = self.history + line.text + '\n'
         self.history = self.history[:-1]
 
-        # has frames
-        for page in self.pages:
-          for frame in page.findall("frame"):
-            self.has_frames = True
-
-    def load_image(self, image_uri):
+        # has frames (coverpage frames do not count)
+        self.has_frames = self.page_frames[-1] > self.page_frames[1]
+
+    def compile_body(self):
+        # pages are compiled once into records, coordinates of all frames go
+        # to one flat int array; frames of page p (coverpage is 0) are
+        # page_frames[p] .. page_frames[p + 1] - 1, coordinates of frame f are
+        # frame_coords[frame_starts[f]:frame_starts[f + 1]] as x, y, x, y ...
+        self.pages = []
+        self.frame_coords = array('i')
+        self.frame_starts = array('i', [0])
+        self.frame_colors = []
+        self.page_frames = array('i', [0])
+        self.add_frames(self.bookinfo.findall("coverpage/" + "frame"))
+        self.compile_references()
+
+        for page in self.tree.findall("body/" + "page"):
+          record = PageRecord()
+          image = page.find("image")
+          if image is not None and image.get("href") is not None:
+            record.image_href = image.get("href")
+          else:
+            record.image_href = ''
+          record.bgcolor = page.get("bgcolor")
+          record.transition = page.get("transition")
+          record.titles = [(title.get("lang"), title.text) for title in page.findall("title")]
+          # text layers are compiled by language when they are needed first
+          record.text_layers = {}
+          for text_layer in page.findall("text-layer"):
+            record.text_layers.setdefault(text_layer.get("lang"), []).append(text_layer)
+          self.pages.append(record)
+          self.add_frames(page.findall("frame"))
+        self.pages_total = len(self.pages)
+
+    def compile_references(self):
+        # footnotes as id -> text, first one wins when id is repeated
+        self.reference_texts = {}
+        if self.references is None:
+          return
+        for item in self.references.findall("reference"):
+          if item.get("id") is not None and item.get("id") not in self.reference_texts:
+            self.reference_texts[item.get("id")] = '\n'.join([line.text or '' for line in item.findall("p")])
+
+    def add_frames(self, xml_frames):
+        for frame in xml_frames:
+          self.frame_coords.extend(get_coordinates(frame.get("points")))
+          self.frame_starts.append(len(self.frame_coords))
+          self.frame_colors.append(frame.get("bgcolor"))
+        self.page_frames.append(len(self.frame_colors))
+
+    def get_text_areas(self, page_num, language):
+        # text areas of page in language, xml of text layer is compiled and
+        # released on first use
+        key = (page_num, language)
+        with self.text_lock:
+          if key not in self.text_areas:
+            text_areas = []
+            for text_layer in self.pages[page_num - 2].text_layers.pop(language, []):
+              if isinstance(text_layer, bytes):
+                text_layer = xml.fromstring(text_layer)
+              if text_layer.get("bgcolor") != None:
+                bgcolor_layer = text_layer.get("bgcolor")
+              else:
+                bgcolor_layer = '#ffffff'
+              for text_area in text_layer.findall("text-area"):
+                text_areas.append(self.compile_text_area(text_area, bgcolor_layer))
+            self.text_areas[key] = text_areas
+          return self.text_areas[key]
+
+    def start_text_extraction(self):
+        # compile all text layers in background, so switching language only renders page
+        if self.valid and self.text_thread is None:
+          self.text_thread = threading.Thread(target=self.extract_texts)
+          self.text_thread.daemon = True
+          self.text_thread.start()
+
+    def extract_texts(self):
+        bookcache.set_low_priority()
+        for page_num, page in enumerate(self.pages, start = 2):
+          with self.text_lock:
+            languages = list(page.text_layers)
+          for language in languages:
+            if self._window.acbf_document is not self:
+              # another book was opened
+              return
+            self.get_text_areas(page_num, language)
+
+    def compile_text_area(self, text_area, bgcolor_layer):
+        record = TextArea()
+        if text_area.get("bgcolor") != None:
+          record.bgcolor = text_area.get("bgcolor")
+        else:
+          record.bgcolor = bgcolor_layer
+        if text_area.get("text-rotation") != None:
+          record.rotation = int(text_area.get("text-rotation"))
+        else:
+          record.rotation = 0
+        if text_area.get("type") != None:
+          record.type = text_area.get("type")
+        else:
+          record.type = 'speech'
+        record.inverted = text_area.get("inverted") != None and text_area.get("inverted").upper() == 'TRUE'
+        record.transparent = text_area.get("transparent") != None and text_area.get("transparent").upper() == 'TRUE'
+        record.coords = get_coordinates(text_area.get("points"))
+        record.bounds = get_bounds(record.coords)
+        record.area = get_area(record.coords)
+
+        record.paragraphs = []
+        reference_ids = []
+        for paragraph in text_area.findall("p"):
+          runs = []
+          add_runs(paragraph, 0, None, runs)
+          record.paragraphs.append(runs)
+          # references, resolved against reference_texts when page is loaded
+          for reference in paragraph.findall("a") + paragraph.findall("commentary/" + "a"):
+            if reference.get("href") is not None and reference.get("href")[1:] in self.reference_texts:
+              reference_ids.append(reference.get("href")[1:])
+        record.text = ' '.join([''.join([run.text for run in runs]) for runs in record.paragraphs])
+        record.reference_ids = tuple(reference_ids)
+        return record
+
+    def load_image(self, image_uri, extract=True):
         #print (image_uri.file_type, image_uri.archive_path, image_uri.file_path, self._window.tempdir, self._window.base_dir)
         try:
           if image_uri.file_type == "embedded":
-            for image in self.binaries:
-              if image.get("id") == image_uri.file_path:
-                decoded = base64.b64decode(image.text)
-                return_image = os.path.join(self.base_dir, image_uri.file_path)
-                file_ = open(return_image, 'w')
-                file_.write(decoded)
-                file_.close()
-                return return_image
+            return self.binary_cache.get_path(image_uri.file_path)
           elif image_uri.file_type == "zip":
-            z = zipfile.ZipFile(os.path.join(self._window.base_dir, image_uri.archive_path))
-            z.extract(image_uri.file_path, self._window.tempdir)
-            return os.path.join(self._window.tempdir, image_uri.file_path)
+            # archive stays open in pool, page is extracted only once
+            return archive.archive_pool.extract(os.path.join(self._window.base_dir, image_uri.archive_path),
+                                                image_uri.file_path.replace(os.sep, '/'), self._window.book_dir)
           elif image_uri.file_type == "http":
               try:
                 http_image = image_uri.file_path
@@ -262,221 +577,123 @@ class ACBFDocument():
               except:
                 print("Error loading image:", image_uri.file_path)
           else:
-            return os.path.join(self.base_dir, image_uri.file_path)
+            image_path = os.path.join(self.base_dir, image_uri.file_path)
+            if extract and self._window.archive is not None and not os.path.isfile(image_path):
+              # book archive is kept open, extract page on demand
+              image_path = self._window.archive.extract_path(image_path)
+            return image_path
 
         except Exception as inst:
           print("Unable to read image: %s" % inst)
           return './images/default.png'
 
-    def load_page_image(self, page_num = 1):
+    def load_image_data(self, image_uri):
+        # image content read into memory, without writing anything to disk
+        try:
+          if image_uri.file_type == "embedded":
+            if image_uri.file_path in self.binaries:
+              return base64.b64decode(self.binaries[image_uri.file_path][1])
+          elif image_uri.file_type == "zip":
+            return archive.archive_pool.read(os.path.join(self._window.base_dir, image_uri.archive_path),
+                                             image_uri.file_path.replace(os.sep, '/'), self._window.book_dir)
+          elif image_uri.file_type != "http":
+            image_path = os.path.join(self.base_dir, image_uri.file_path)
+            if self._window.archive is not None:
+              name = self._window.archive.member_name(image_path)
+              if name in self._window.archive.infos:
+                return self._window.archive.read(name)
+            with open(image_path, 'rb') as f:
+              return f.read()
+        except Exception as inst:
+          print("Unable to read image: %s" % inst)
+        return None
+
+    def load_page_image(self, page_num = 1, extract=True):
         if page_num == 1:
           pilBackgroundImage = self.coverpage
           page_bg_color = '#000000'
         else:
-          image_id = self.pages[page_num - 2].find("image").get("href")
-          page_bg_color = self.pages[page_num - 2].get("bgcolor")
+          image_id = self.pages[page_num - 2].image_href
+          page_bg_color = self.pages[page_num - 2].bgcolor
           if page_bg_color == None:
             page_bg_color = self.bg_color
 
           image_uri = ImageURI(image_id)
-          pilBackgroundImage = self.load_image(image_uri)
+          pilBackgroundImage = self.load_image(image_uri, extract)
 
         return pilBackgroundImage, page_bg_color
 
-    def load_page_frames(self, page_num = 1):
+    def get_page_member(self, page_num):
+        # name of page image inside book archive kept open, None if it is not there
         if page_num == 1:
-          xml_frames = self.bookinfo.findall("coverpage/" + "frame")
-          if xml_frames == None:
-            return []
+          image_uri = self.coverpage_uri
         else:
-          xml_frames = self.pages[page_num - 2].findall("frame")
+          image_uri = ImageURI(self.pages[page_num - 2].image_href)
+        if image_uri.file_type != 'unknown' or self._window.archive is None:
+          return None
+        name = self._window.archive.member_name(os.path.join(self.base_dir, image_uri.file_path))
+        if name not in self._window.archive.infos:
+          return None
+        return name
+
+    def load_page_frames(self, page_num = 1):
         frames = []
-        coordinate_list = []
-        for frame in xml_frames:
-          for coordinate in frame.get("points").split(' '):
-            coordinate_tuple = (int(coordinate.split(',')[0]), int(coordinate.split(',')[1]))
-            coordinate_list.append(coordinate_tuple)
-          frame_tuple = (coordinate_list, frame.get("bgcolor"))
-          frames.append(frame_tuple)
-          coordinate_list = []
+        for frame in range(self.page_frames[page_num - 1], self.page_frames[page_num]):
+          coords = self.frame_coords[self.frame_starts[frame]:self.frame_starts[frame + 1]]
+          frames.append((list(zip(coords[0::2], coords[1::2])), self.frame_colors[frame]))
         return frames
 
     def load_page_texts(self, page_num, language):
-        text_areas = []
-        references = []
-        all_lines = ''
-        text_rotation = 0
-        area_type = 'speech'
-        inverted = False
+        # text areas of page as TextArea records, references as (id, text)
         if page_num == 1:
-          return text_areas, references
-        for text_layer in self.pages[page_num - 2].findall("text-layer"):
-          if text_layer.get("bgcolor") != None:
-            bgcolor_layer = text_layer.get("bgcolor")
-          else:
-            bgcolor_layer = '#ffffff'
-          if text_layer.get("lang") == language:
-            for text_area in text_layer.findall("text-area"):
-              if text_area.get("bgcolor") != None:
-                bgcolor = text_area.get("bgcolor")
-              else:
-                bgcolor = bgcolor_layer
-              if text_area.get("text-rotation") != None:
-                text_rotation = int(text_area.get("text-rotation"))
-              else:
-                text_rotation = 0
-              if text_area.get("type") != None:
-                area_type = text_area.get("type")
-              else:
-                area_type = 'speech'
-              if text_area.get("inverted") == None:
-                inverted = False
-              elif text_area.get("inverted").upper() == 'TRUE':
-                inverted = True
-              else:
-                inverted = False
-              if text_area.get("transparent") == None:
-                transparent = False
-              elif text_area.get("transparent").upper() == 'TRUE':
-                transparent = True
-              else:
-                transparent = False
-              coordinate_list = []
-              area_text = u''
-              for coordinate in text_area.get("points").split(' '):
-                coordinate_tuple = (int(coordinate.split(',')[0]), int(coordinate.split(',')[1]))
-                coordinate_list.append(coordinate_tuple)
-              for paragraph in text_area.findall("p"):
-                paragraph_unicode = xml.tostring(paragraph, encoding='unicode')
-                paragraph_end = paragraph_unicode.find('</p>') + 4
-                paragraph_unicode = paragraph_unicode[0:paragraph_end]
-                area_text = area_text + re.sub(r'<p[^>]*>', "", paragraph_unicode).replace(u'</p>', u' <BR>')
-                # references
-                for reference in paragraph.findall("a"):
-                  for item in self.references.findall("reference"):
-                    if item.get("id") == reference.get("href")[1:]:
-                      all_lines = ''
-                      for line in item.findall("p"):
-                        all_lines = all_lines + line.text + '\n'
-                      all_lines = all_lines[:-2]
-                      references.append((reference.get("href")[1:], all_lines))
-                for commentary in paragraph.findall("commentary"): 
-                  for reference in commentary.findall("a"):
-                    for item in self.references.findall("reference"):
-                      if item.get("id") == reference.get("href")[1:]:
-                        all_lines = ''
-                        for line in item.findall("p"):
-                          all_lines = all_lines + line.text + '\n'
-                        all_lines = all_lines[:-2]
-                        references.append((reference.get("href")[1:], all_lines))
-
-              area_text = area_text[:-5]
-              text_area_tuple = (coordinate_list, area_text, bgcolor, text_rotation, area_type, inverted, transparent)
-              text_areas.append(text_area_tuple)
-
-        #print(xml.tostring(text_areas[0][1][0], encoding='unicode', pretty_print=True))
-
-        return text_areas, references
+          return [], []
+        text_areas = self.get_text_areas(page_num, language)
+        references = []
+        for text_area in text_areas:
+          for reference_id in text_area.reference_ids:
+            references.append((reference_id, self.reference_texts[reference_id]))
+        return list(text_areas), references
 
     def get_page_transition(self, page_num):
-        if self.pages[page_num - 2].get("transition") == None:
+        if self.pages[page_num - 2].transition == None:
           return 'undefined'
         else:
-          return self.pages[page_num - 2].get("transition")
+          return self.pages[page_num - 2].transition
 
     def get_contents_table(self):
         self.contents_table = []
         for lang in self.languages:
           contents = []
           for idx, page in enumerate(self.pages, start = 2):
-            for title in page.findall("title"):
-              if ((title.get("lang") == lang[0]) or (title.get("lang") == None)):
-                contents.append((title.text, str(idx)))
+            for title_lang, title in page.titles:
+              if ((title_lang == lang[0]) or (title_lang == None)):
+                contents.append((title, str(idx)))
           if len(contents) > 0:
             self.contents_table.append(contents)
 
     def load_stylesheet(self):
-        #print(self.stylesheet.text)
-        #sheet = cssutils.parseString(self.stylesheet.text)
-        font = ''
-
-        for rule in self.stylesheet.text.replace('\n', ' ').split('}'):
-          if rule.strip() != '':
-            selector = rule.strip().split('{')[0].strip().upper()
-            #print("selectorText: ", selector)
-            font_style = 'normal'
-            font_weight = 'normal'
-            font_stretch = 'normal'
-            font_families = ''
-            for style in rule.strip().split('{')[1].strip().split(';'):
-              if style != '':
-                #print("style:", style.split(':')[0].strip())
-                #print("value:", style.split(':')[1].strip())
-                current_style = style.split(':')[0].strip().upper()
-                if current_style == 'FONT-FAMILY':
-                  font_families = style.split(':')[1].strip()
-                elif current_style == 'FONT-STYLE':
-                  font_style = style.split(':')[1].strip()
-                elif current_style == 'FONT-WEIGHT':
-                  font_weight = style.split(':')[1].strip()
-                elif current_style == 'FONT-SRTRETCH':
-                  font_stretch = style.split(':')[1].strip()
-
-                if selector == '*' and current_style == 'COLOR':
-                  self.font_colors['speech'] = style.split(':')[1].strip().strip('"')
-                elif selector == 'TEXT-AREA' and current_style == 'COLOR':
-                  self.font_colors['speech'] = style.split(':')[1].strip().strip('"')
-                elif selector == 'TEXT-AREA[INVERTED=TRUE]' and current_style == 'COLOR':
-                  self.font_colors['inverted'] = style.split(':')[1].strip().strip('"')
-                elif selector == 'TEXT-AREA[TYPE=SPEECH]' and current_style == 'COLOR':
-                  self.font_colors['speech'] = style.split(':')[1].strip().strip('"')
-                elif selector == 'TEXT-AREA[TYPE=COMMENTARY]' and current_style == 'COLOR':
-                  self.font_colors['commentary'] = style.split(':')[1].strip().strip('"')
-                elif selector == 'TEXT-AREA[TYPE=FORMAL]' and current_style == 'COLOR':
-                  self.font_colors['formal'] = style.split(':')[1].strip().strip('"')
-                elif selector == 'TEXT-AREA[TYPE=LETTER]' and current_style == 'COLOR':
-                  self.font_colors['letter'] = style.split(':')[1].strip().strip('"')
-                elif selector == 'TEXT-AREA[TYPE=CODE]' and current_style == 'COLOR':
-                  self.font_colors['code'] = style.split(':')[1].strip().strip('"')
-                elif selector == 'TEXT-AREA[TYPE=HEADING]' and current_style == 'COLOR':
-                  self.font_colors['heading'] = style.split(':')[1].strip().strip('"')
-                elif selector == 'TEXT-AREA[TYPE=AUDIO]' and current_style == 'COLOR':
-                  self.font_colors['audio'] = style.split(':')[1].strip().strip('"')
-                elif selector == 'TEXT-AREA[TYPE=THOUGHT]' and current_style == 'COLOR':
-                  self.font_colors['thought'] = style.split(':')[1].strip().strip('"')
-                elif selector == 'TEXT-AREA[TYPE=SIGN]' and current_style == 'COLOR':
-                  self.font_colors['sign'] = style.split(':')[1].strip().strip('"')
-
-            if font_families != '':
-              for font_family in font_families.split(','):
-                #check if font exists in acbf document
-                font_family_stripped = font_family.strip().strip('"')
-                if os.path.isfile(os.path.join(self.fonts_dir, font_family_stripped)):
-                  font = os.path.join(self.fonts_dir, font_family_stripped)
-                  break
-
-            if selector in ('P', 'TEXT-AREA') and font != '':
-              self.font_styles['normal'] = font
-            elif selector == 'EMPHASIS' and font != '':
-              self.font_styles['emphasis'] = font
-            elif selector == 'STRONG' and font != '':
-              self.font_styles['strong'] = font
-            elif selector in ('CODE', 'TEXT-AREA[TYPE=CODE]', 'TEXT-AREA[TYPE="CODE"]') and font != '':
-              self.font_styles['code'] = font
-            elif selector in ('COMMENTARY', 'TEXT-AREA[TYPE=COMMENTARY]', 'TEXT-AREA[TYPE="COMMENTARY"]') and font != '':
-              self.font_styles['commentary'] = font
-            elif selector in ('TEXT-AREA[TYPE=SIGN]', 'TEXT-AREA[TYPE="SIGN"]') and font != '':
-              self.font_styles['sign'] = font
-            elif selector in ('TEXT-AREA[TYPE=FORMAL]', 'TEXT-AREA[TYPE="FORMAL"]') and font != '':
-              self.font_styles['formal'] = font
-            elif selector in ('TEXT-AREA[TYPE=HEADING]', 'TEXT-AREA[TYPE="HEADING"]') and font != '':
-              self.font_styles['heading'] = font
-            elif selector in ('TEXT-AREA[TYPE=LETTER]', 'TEXT-AREA[TYPE="LETTER"]') and font != '':
-              self.font_styles['letter'] = font
-            elif selector in ('TEXT-AREA[TYPE=AUDIO]', 'TEXT-AREA[TYPE="AUDIO"]') and font != '':
-              self.font_styles['audio'] = font
-            elif selector in ('TEXT-AREA[TYPE=THOUGHT]', 'TEXT-AREA[TYPE="THOUGHT"]') and font != '':
-              self.font_styles['thought'] = font
+        # selector -> {property: value}, kept in snapshot with the rest of document
+        self.styles = parse_stylesheet(self.stylesheet.text or '')
+
+        # colors, more specific selectors go later
+        for selector in ('*', 'text-area', 'text-area[type=speech]'):
+          if 'color' in self.styles.get(selector, {}):
+            self.font_colors['speech'] = self.styles[selector]['color'].strip('"\'')
+        if 'color' in self.styles.get('text-area[inverted=true]', {}):
+          self.font_colors['inverted'] = self.styles['text-area[inverted=true]']['color'].strip('"\'')
+        for area_type in ('commentary', 'formal', 'letter', 'code', 'heading', 'audio', 'thought', 'sign'):
+          selector = 'text-area[type=' + area_type + ']'
+          if 'color' in self.styles.get(selector, {}):
+            self.font_colors[area_type] = self.styles[selector]['color'].strip('"\'')
+
+        # fonts, first font of font-family list that exists in acbf document is used
+        for style, selectors in FONT_SELECTORS:
+          for selector in selectors:
+            for font_family in split_list(self.styles.get(selector, {}).get('font-family', ''), ','):
+              font = os.path.join(self.fonts_dir, font_family.strip('"\''))
+              if font_family != '' and os.path.isfile(font):
+                self.font_styles[style] = font
+                break
 
         for style in ['emphasis', 'strong', 'code', 'commentary', 'sign', 'formal', 'heading', 'letter', 'audio', 'thought']:
           if self.font_styles[style] == '':
@@ -488,13 +705,100 @@ class ACBFDocument():
         shutil.copytree(os.path.join(self.base_dir, 'Fonts'), self.fonts_dir)
       if not os.path.exists(self.fonts_dir):
         os.makedirs(self.fonts_dir, 0o700)
-      for font in self.binaries:
-        if font.get("content-type") == 'application/font-sfnt':
-          decoded = base64.b64decode(font.text)
-          f = open(os.path.join(self.fonts_dir, font.get("id")), 'wb')
+      for font_id, (content_type, font_data) in self.binaries.items():
+        if content_type == 'application/font-sfnt':
+          if os.path.isfile(os.path.join(self.fonts_dir, font_id)):
+            continue
+          decoded = base64.b64decode(font_data)
+          f = open(os.path.join(self.fonts_dir, font_id), 'wb')
           f.write(decoded)
           f.close()
 
+class BinaryCache():
+    """Embedded binaries decoded on first use into files in cache_dir. Least
+    recently used files are deleted when they take more than budget bytes.
+    """
+
+    def __init__(self, binaries, cache_dir, budget):
+        self.binaries = binaries
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self.files = OrderedDict()
+        self.size = 0
+        # pages are also loaded by CachedImage thread
+        self.lock = threading.Lock()
+
+    def get_path(self, binary_id):
+        if binary_id not in self.binaries:
+          return None
+        with self.lock:
+          if binary_id in self.files:
+            self.files.move_to_end(binary_id)
+            return self.files[binary_id][0]
+
+        # id comes from document, file is named by its hash so it stays in cache_dir
+        extension = os.path.splitext(binary_id.replace('\\', '/'))[1]
+        if not BINARY_EXTENSION.match(extension):
+          extension = ''
+        path = os.path.join(self.cache_dir, hashlib.sha1(binary_id.encode('utf-8', 'surrogateescape')).hexdigest() + extension)
+        if not os.path.isfile(path):
+          os.makedirs(self.cache_dir, exist_ok=True)
+          # written next to target first, other thread may decode the same binary
+          part_file = path + '.' + str(threading.get_ident()) + '.part'
+          with open(part_file, 'wb') as f:
+            f.write(base64.b64decode(self.binaries[binary_id][1]))
+          os.replace(part_file, path)
+
+        with self.lock:
+          if binary_id not in self.files:
+            size = os.path.getsize(path)
+            self.files[binary_id] = (path, size)
+            self.size = self.size + size
+            self.evict()
+        return path
+
+    def evict(self):
+        # newest file is kept even when it is over budget on its own
+        while self.size > self.budget and len(self.files) > 1:
+          binary_id, (path, size) = self.files.popitem(last=False)
+          self.size = self.size - size
+          try:
+            os.unlink(path)
+          except OSError:
+            pass
+
+class PageRecord():
+    """Page of document body, compiled at load so lxml elements can be freed.
+    text_layers is language -> list of text-layer elements (or their xml, when
+    document was loaded from snapshot) not compiled yet.
+    """
+
+    __slots__ = ('image_href', 'bgcolor', 'transition', 'titles', 'text_layers')
+
+class TextArea():
+    """Text area compiled at load. coords are x, y, x, y ... in int array,
+    bounds (x_min, y_min, x_max, y_max) and area of polygon are computed once.
+    paragraphs are lists of TextRun, text is plain text of all of them.
+    """
+
+    __slots__ = ('coords', 'bounds', 'area', 'text', 'paragraphs', 'bgcolor', 'rotation', 'type', 'inverted', 'transparent', 'reference_ids')
+
+    @property
+    def points(self):
+        return list(zip(self.coords[0::2], self.coords[1::2]))
+
+class TextRun():
+    """Piece of paragraph text with the same style; flags are RUN_* bits,
+    link is id of reference the text points to or None.
+    """
+
+    __slots__ = ('text', 'flags', 'link')
+
+    def __init__(self, text, flags, link):
+        self.text = text
+        self.flags = flags
+        self.link = link
+
 class ImageURI():
 
     def __init__(self, input_path):
@@ -533,3 +837,137 @@ def get_element_text(element_tree, element):
       text_value = ''
     return text_value
 
+# function to parse points attribute ("x,y x,y ...") into flat int array
+def get_coordinates(points):
+    coords = array('i')
+    if points is None:
+      return coords
+    for coordinate in points.split():
+      x, y = coordinate.split(',')
+      coords.append(int(x))
+      coords.append(int(y))
+    return coords
+
+def get_bounds(coords):
+    if len(coords) == 0:
+      return (0, 0, 0, 0)
+    return (min(coords[0::2]), min(coords[1::2]), max(coords[0::2]), max(coords[1::2]))
+
+def get_area(coords):
+    xs = coords[0::2]
+    ys = coords[1::2]
+    n = len(xs)
+    return 0.5 * abs(sum(xs[i] * ys[(i + 1) % n] - xs[(i + 1) % n] * ys[i] for i in range(n)))
+
+# function to split inline markup of element into runs of text with the same style
+def add_runs(element, flags, link, runs):
+    if element.text:
+      add_run(element.text, flags, link, runs)
+    for child in element:
+      if isinstance(child.tag, str):
+        tag = child.tag.lower()
+        child_link = link
+        if tag == 'a' and child.get("href") is not None:
+          child_link = child.get("href")[1:]
+        add_runs(child, flags | RUN_STYLES.get(tag, 0), child_link, runs)
+      if child.tail:
+        add_run(child.tail, flags, link, runs)
+
+def add_run(text, flags, link, runs):
+    text = WHITESPACE.sub(' ', text)
+    if len(runs) > 0 and runs[-1].flags == flags and runs[-1].link == link:
+      runs[-1].text = runs[-1].text + text
+    else:
+      runs.append(TextRun(text, flags, link))
+
+def prune_snapshots(snapshot_dir):
+    snapshots = []
+    for entry in os.scandir(snapshot_dir):
+      if entry.name.endswith('.pickle'):
+        snapshots.append((entry.stat().st_mtime, entry.path))
+    for mtime, path in sorted(snapshots)[:max(0, len(snapshots) - SNAPSHOT_LIMIT)]:
+      try:
+        os.unlink(path)
+      except OSError:
+        pass
+
+
+# function to compile stylesheet into selector -> {property: value}; declarations
+# of repeated selectors are merged in order, rules inside @media are read as
+# any other, other at-rules are skipped
+def parse_stylesheet(text):
+    styles = {}
+    blocks = [] # 'rule', 'group' or 'skip' for each open block
+    selectors = []
+    declarations = {}
+    buffer = ''
+    for token in CSS_TOKEN.findall(text):
+      if token.startswith('/*'):
+        continue
+      elif token == '{':
+        prelude = buffer.strip()
+        buffer = ''
+        if 'skip' in blocks or 'rule' in blocks:
+          blocks.append('skip')
+        elif prelude.startswith('@'):
+          if prelude.lower().startswith(('@media', '@supports')):
+            blocks.append('group')
+          else:
+            blocks.append('skip')
+        else:
+          blocks.append('rule')
+          selectors = [get_selector(selector) for selector in split_list(prelude, ',')]
+          declarations = {}
+      elif token == '}':
+        if len(blocks) > 0 and blocks[-1] == 'rule':
+          add_declaration(buffer, declarations)
+          for selector in selectors:
+            if selector != '':
+              styles.setdefault(selector, {}).update(declarations)
+        buffer = ''
+        if len(blocks) > 0:
+          blocks.pop()
+      elif token == ';':
+        if len(blocks) > 0 and blocks[-1] == 'rule':
+          add_declaration(buffer, declarations)
+        buffer = ''
+      else:
+        buffer = buffer + token
+    return styles
+
+def add_declaration(text, declarations):
+    name, colon, value = text.partition(':')
+    name = name.strip().lower()
+    value = CSS_IMPORTANT.sub('', value.strip())
+    if colon != '' and name != '' and value != '':
+      declarations[name] = value
+
+# function to bring selector to the form it is looked up by: text-area[type=code]
+def get_selector(selector):
+    selector = CSS_ATTRIBUTE.sub(lambda match: '[' + match.group(1) + '=' + match.group(2).strip() + ']', selector)
+    return WHITESPACE.sub(' ', selector).strip().lower()
+
+# function to split comma separated list, separators inside quotes or brackets are left alone
+def split_list(text, separator):
+    items = []
+    item = ''
+    quote = None
+    depth = 0
+    for character in text:
+      if quote is not None:
+        if character == quote:
+          quote = None
+      elif character in '"\'':
+        quote = character
+      elif character in '([':
+        depth = depth + 1
+      elif character in ')]':
+        depth = max(0, depth - 1)
+      elif character == separator and depth == 0:
+        items.append(item.strip())
+        item = ''
+        continue
+      item = item + character
+    if item.strip() != '':
+      items.append(item.strip())
+    return items
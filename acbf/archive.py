@@ -0,0 +1,934 @@
+"""archive.py - on demand access to comic book archive members.
+
+Copyright (C) 2011-2024 Robert Kubik
+https://github.com/ACBF-Advanced-Comic-Book-Format
+"""
+
+# -------------------------------------------------------------------------
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# -------------------------------------------------------------------------
+
+
+import os
+import io
+import mmap
+import hashlib
+import shutil
+import struct
+import threading
+import time
+import tarfile
+import zipfile
+import zlib
+from collections import OrderedDict
+import lxml.etree as xml
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+  import py7zr
+except Exception:
+  py7zr = None
+
+IMAGE_EXTENSIONS = ('.JPG', '.PNG', '.GIF', 'WEBP', '.BMP', 'JPEG')
+FONT_EXTENSIONS = ('.TTF', '.OTF')
+INDEX_VERSION = '1'
+CHUNK_SIZE = 256 * 1024
+
+# gzip, bzip2 and xz signatures of compressed tar
+COMPRESSED_MAGIC = (b'\x1f\x8b', b'BZh', b'\xfd7zXZ')
+
+# JPEG start of frame markers, they hold image dimensions
+JPEG_SOF_MARKERS = (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF)
+# header bytes read at most when looking for image dimensions
+IMAGE_HEADER_LIMIT = 512 * 1024
+
+# member of solid RAR archive uses data of previous ones, see RHDF_SOLID in unrar.dll manual
+RAR_SOLID_FLAG = 0x10
+
+# local file header, see zipfile.structFileHeader
+LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+
+class MemberIndex():
+    """Central directory of an archive persisted in index_dir, keyed by path,
+    size and modification time, so reopening a book does not walk it again.
+    """
+
+    def __init__(self, index_dir, filename):
+      self.index_dir = index_dir
+      self.filename = filename
+      self.index_file_path = os.path.join(index_dir, hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest() + '.xml')
+      stat = os.stat(filename)
+      self.size = str(stat.st_size)
+      self.mtime = str(stat.st_mtime_ns)
+      self.valid = False
+      self.file_type = None
+      self.members = {}
+      self.pages = []
+      self.cover = ''
+      self.image_sizes = {}
+      self.modified = False
+      self.load_index()
+
+    def load_index(self):
+      if not os.path.isfile(self.index_file_path):
+        return
+      try:
+        root = xml.parse(source = self.index_file_path).getroot()
+      except Exception as inst:
+        print("Unable to read archive index: %s" % inst)
+        return
+      if (root.get("version") != INDEX_VERSION or root.get("size") != self.size or
+          root.get("mtime") != self.mtime):
+        return
+
+      self.file_type = root.get("type")
+      pages = []
+      for member in root.findall("member"):
+        info = zipfile.ZipInfo(member.get("name"))
+        info.header_offset = int(member.get("offset"))
+        info.compress_size = int(member.get("csize"))
+        info.file_size = int(member.get("size"))
+        info.compress_type = int(member.get("method"))
+        info.CRC = int(member.get("crc"))
+        info.flag_bits = int(member.get("flags"))
+        self.members[info.filename] = info
+        if member.get("width") is not None:
+          self.image_sizes[info.filename] = (int(member.get("width")), int(member.get("height")))
+        if member.get("page") is not None:
+          pages.append((int(member.get("page")), info.filename))
+      self.pages = [page[1] for page in sorted(pages)]
+      if len(self.pages) > 0:
+        self.cover = self.pages[0]
+      self.valid = True
+      # book cache removes least recently used indexes first
+      try:
+        os.utime(self.index_file_path, None)
+      except OSError:
+        pass
+
+    def build(self, file_type, infolist):
+      self.file_type = file_type
+      self.members = {}
+      for info in infolist:
+        self.members[info.filename] = info
+      self.pages = sorted([name for name in self.members if name[-4:].upper() in IMAGE_EXTENSIONS and is_safe_name(name)])
+      if len(self.pages) > 0:
+        self.cover = self.pages[0]
+      self.valid = True
+      self.save_index()
+
+    def save_index(self):
+      # member names that xml cannot hold (control characters) leave book without saved index
+      try:
+        root = xml.Element("index", version=INDEX_VERSION, size=self.size, mtime=self.mtime, type=self.file_type)
+        page_numbers = {}
+        for idx, name in enumerate(self.pages):
+          page_numbers[name] = idx
+        for info in self.members.values():
+          member = xml.SubElement(root, "member", name=info.filename, offset=str(getattr(info, 'header_offset', 0)),
+                                  csize=str(info.compress_size), size=str(info.file_size), method=str(getattr(info, 'compress_type', 0)),
+                                  crc=str(getattr(info, 'CRC', 0)), flags=str(getattr(info, 'flag_bits', 0)))
+          if info.filename in page_numbers:
+            member.set("page", str(page_numbers[info.filename]))
+          if info.filename in self.image_sizes:
+            member.set("width", str(self.image_sizes[info.filename][0]))
+            member.set("height", str(self.image_sizes[info.filename][1]))
+        if not os.path.exists(self.index_dir):
+          os.makedirs(self.index_dir, 0o700)
+        f = open(self.index_file_path + '.part', 'wb')
+        f.write(xml.tostring(root, encoding='utf-8'))
+        f.close()
+        os.replace(self.index_file_path + '.part', self.index_file_path)
+        self.modified = False
+      except Exception as inst:
+        print("Unable to save archive index: %s" % inst)
+
+    def namelist(self):
+      return list(self.members)
+
+    def set_image_size(self, name, size):
+      self.image_sizes[name] = size
+      self.modified = True
+
+class MemberArchive():
+    """Common part of archives that extract members into outdir only when
+    they are asked for. Subclasses fill infos (name -> ZipInfo like record)
+    and provide iter_member().
+    """
+
+    def __init__(self, filename, outdir, index=None):
+      self.filename = filename
+      self.outdir = outdir
+      self.index = index
+      self.infos = {}
+      self.names = []
+
+    def drop_unsafe_names(self):
+      # members that would land outside outdir are left out, as zipfile.extract
+      # drops their .. components, so they never fail extraction of the book
+      for name in [name for name in self.infos if not is_safe_name(name)]:
+        print("Skipping unsafe archive member:", name)
+        del self.infos[name]
+      self.names = list(self.infos)
+
+    def namelist(self):
+      return self.names
+
+    def getinfo(self, name):
+      return self.infos[name]
+
+    def member_path(self, name):
+      return os.path.join(self.outdir, *name.split('/'))
+
+    def member_name(self, path):
+      return os.path.relpath(path, self.outdir).replace(os.sep, '/')
+
+    def read(self, name):
+      return b''.join(self.iter_member(name))
+
+    def is_stored(self, name):
+      # stored members are read straight from archive, they are not extracted ahead
+      return False
+
+    def open_member(self, name):
+      # binary file object with member content
+      return io.BytesIO(self.read(name))
+
+    def open_path(self, path):
+      # file object for path inside outdir, read from archive when it is not extracted
+      name = self.member_name(path)
+      if name in self.infos and not os.path.isfile(path):
+        return self.open_member(name)
+      return open(path, 'rb')
+
+    def image_size(self, name):
+      # dimensions from image header, remembered in index; None if header is not understood
+      if self.index is not None and name in self.index.image_sizes:
+        return self.index.image_sizes[name]
+      if os.path.isfile(self.member_path(name)):
+        with open(self.member_path(name), 'rb') as f:
+          size = get_image_size(iter(lambda: f.read(CHUNK_SIZE), b''))
+      else:
+        size = get_image_size(self.iter_member(name))
+      if size is not None and self.index is not None:
+        self.index.set_image_size(name, size)
+      return size
+
+    def extract(self, name):
+      target = self.member_path(name)
+      if os.path.isfile(target):
+        return target
+      if not is_safe_name(name):
+        raise ValueError("Unsafe archive member name: %s" % name)
+
+      if not os.path.exists(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target), 0o700, exist_ok=True)
+      if name.endswith('/'):
+        return target
+
+      # write next to target first, so half extracted page is never picked up
+      part_file = target + '.' + str(threading.get_ident()) + '.part'
+      try:
+        with open(part_file, 'wb') as dest:
+          for chunk in self.iter_member(name):
+            dest.write(chunk)
+        os.replace(part_file, target)
+      finally:
+        if os.path.exists(part_file):
+          os.unlink(part_file)
+      return target
+
+    def is_solid(self):
+      # members of solid archive are reached only by decompressing everything before them
+      return False
+
+    def extract_members(self, names):
+      # members extracted in one pass over archive into part directory and
+      # moved into place when it is done, used for solid archives
+      names = [name for name in names if is_safe_name(name) and not name.endswith('/')]
+      part_dir = os.path.join(self.outdir, '.' + str(threading.get_ident()) + '.part')
+      try:
+        self.extract_all(part_dir, names)
+        for name in names:
+          source = os.path.join(part_dir, *name.split('/'))
+          target = self.member_path(name)
+          if os.path.isfile(source) and not os.path.isfile(target):
+            if not os.path.exists(os.path.dirname(target)):
+              os.makedirs(os.path.dirname(target), 0o700, exist_ok=True)
+            os.replace(source, target)
+      finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+    def extract_all(self, path, names):
+      for name in names:
+        target = os.path.join(path, *name.split('/'))
+        if not os.path.exists(os.path.dirname(target)):
+          os.makedirs(os.path.dirname(target), 0o700, exist_ok=True)
+        with open(target, 'wb') as dest:
+          for chunk in self.iter_member(name):
+            dest.write(chunk)
+
+    def extract_path(self, path):
+      # path inside outdir as resolved by ACBFDocument
+      name = self.member_name(path)
+      if name in self.infos:
+        return self.extract(name)
+      return path
+
+    def close(self):
+      pass
+
+class ZipArchive(MemberArchive):
+    """Keeps a CBZ file open and extracts its members into outdir only when
+    they are asked for. Members are read directly at offsets known from
+    index, ZipFile is used only for compression methods zlib can't handle.
+    """
+
+    def __init__(self, filename, outdir, index=None):
+      MemberArchive.__init__(self, filename, outdir, index)
+      self.z = None
+      self.mm = None
+      self.read_lock = threading.Lock()
+      if index is not None and index.valid:
+        self.infos = dict(index.members)
+      else:
+        for info in self.zipfile().infolist():
+          self.infos[info.filename] = info
+      self.drop_unsafe_names()
+      self.fd = os.open(filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+
+    def zipfile(self):
+      with self.read_lock:
+        if self.z is None:
+          self.z = zipfile.ZipFile(self.filename)
+      return self.z
+
+    def mmap(self):
+      with self.read_lock:
+        if self.mm is None:
+          self.mm = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+      return self.mm
+
+    def is_stored(self, name):
+      info = self.infos[name]
+      return info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1 and info.file_size > 0
+
+    def open_member(self, name):
+      # stored members are read straight from mapped archive, without copying them
+      info = self.infos[name]
+      if self.is_stored(name):
+        offset = self.data_offset(info)
+        return MemberView(memoryview(self.mmap())[offset:offset + info.file_size])
+      return io.BytesIO(self.read(name))
+
+    def read_at(self, offset, size):
+      if hasattr(os, 'pread'):
+        return os.pread(self.fd, size, offset)
+      with self.read_lock:
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        return os.read(self.fd, size)
+
+    def data_offset(self, info):
+      header = LOCAL_HEADER.unpack(self.read_at(info.header_offset, LOCAL_HEADER.size))
+      if header[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad local file header: %s" % info.filename)
+      return info.header_offset + LOCAL_HEADER.size + header[10] + header[11]
+
+    def iter_member(self, name):
+      # yields uncompressed member data in chunks
+      info = self.infos[name]
+      if info.flag_bits & 0x1 or info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        with self.zipfile().open(name) as source:
+          chunk = source.read(CHUNK_SIZE)
+          while chunk:
+            yield chunk
+            chunk = source.read(CHUNK_SIZE)
+        return
+
+      offset = self.data_offset(info)
+      remaining = info.compress_size
+      decompressor = None
+      if info.compress_type == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-15)
+      crc = 0
+      while remaining > 0:
+        chunk = self.read_at(offset, min(CHUNK_SIZE, remaining))
+        if not chunk:
+          raise zipfile.BadZipFile("Truncated member: %s" % name)
+        offset = offset + len(chunk)
+        remaining = remaining - len(chunk)
+        if decompressor is not None:
+          chunk = decompressor.decompress(chunk)
+        crc = zlib.crc32(chunk, crc)
+        yield chunk
+      if decompressor is not None:
+        chunk = decompressor.flush()
+        crc = zlib.crc32(chunk, crc)
+        yield chunk
+      if crc != info.CRC:
+        raise zipfile.BadZipFile("Bad CRC-32 for file: %s" % name)
+
+    def close(self):
+      if self.mm is not None:
+        try:
+          self.mm.close()
+        except BufferError:
+          # member view still open, mapping is released with it
+          pass
+      os.close(self.fd)
+      if self.z is not None:
+        self.z.close()
+
+class MemberView(io.RawIOBase):
+    """Read only file object over memory of stored archive member, for image
+    decoders. Nothing is copied until it is read.
+    """
+
+    def __init__(self, view):
+      io.RawIOBase.__init__(self)
+      self.view = view
+      self.pos = 0
+
+    def readable(self):
+      return True
+
+    def seekable(self):
+      return True
+
+    def readinto(self, buffer):
+      size = max(0, min(len(buffer), len(self.view) - self.pos))
+      buffer[:size] = self.view[self.pos:self.pos + size]
+      self.pos = self.pos + size
+      return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+      if whence == io.SEEK_CUR:
+        offset = self.pos + offset
+      elif whence == io.SEEK_END:
+        offset = len(self.view) + offset
+      self.pos = max(0, offset)
+      return self.pos
+
+    def tell(self):
+      return self.pos
+
+    def getbuffer(self):
+      return self.view
+
+    def close(self):
+      if not self.closed:
+        self.view.release()
+      io.RawIOBase.close(self)
+
+class RarArchive(MemberArchive):
+    """Same member access as ZipArchive for CBR files. Members are pulled out
+    one at a time with unrar, which skips over headers of the others (in solid
+    archives it has to decompress everything stored before the member).
+    """
+
+    def __init__(self, filename, outdir, index=None):
+      MemberArchive.__init__(self, filename, outdir, index)
+      self.r = None
+      self.lock = threading.Lock()
+      if index is not None and index.valid:
+        self.infos = dict(index.members)
+      else:
+        for info in self.rarfile().infolist():
+          self.infos[info.filename] = info
+      self.drop_unsafe_names()
+
+    def rarfile(self):
+      # unrar reads all headers when opened, so it is opened only when needed
+      if self.r is None:
+        from unrar import rarfile
+        self.r = rarfile.RarFile(self.filename)
+      return self.r
+
+    def iter_member(self, name):
+      with self.lock:
+        data = self.rarfile().read(name)
+      yield data
+
+    def is_solid(self):
+      for info in self.infos.values():
+        if getattr(info, 'flag_bits', 0) & RAR_SOLID_FLAG:
+          return True
+      return False
+
+    def extract_all(self, path, names):
+      # unrar walks archive once, opened on its own so pages can be read meanwhile
+      from unrar import rarfile
+      rarfile.RarFile(self.filename).extractall(path, set(names))
+
+    def close(self):
+      self.r = None
+
+class TarArchive(MemberArchive):
+    """Member access for CBT files. Members of uncompressed tar are read
+    straight from their data offsets, compressed tar goes through tarfile.
+    """
+
+    def __init__(self, filename, outdir, index=None):
+      MemberArchive.__init__(self, filename, outdir, index)
+      self.t = None
+      self.lock = threading.Lock()
+      with open(filename, 'rb') as f:
+        self.compressed = f.read(6).startswith(COMPRESSED_MAGIC)
+      if index is not None and index.valid:
+        self.infos = dict(index.members)
+      else:
+        for info in get_tar_infolist(filename):
+          self.infos[info.filename] = info
+      self.drop_unsafe_names()
+      self.fd = os.open(filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+
+    def tarfile(self):
+      if self.t is None:
+        self.t = tarfile.open(self.filename)
+        self.members = {}
+        for member in self.t.getmembers():
+          self.members[get_tar_member_name(member)] = member
+      return self.t
+
+    def iter_member(self, name):
+      info = self.infos[name]
+      if self.compressed:
+        with self.lock:
+          source = self.tarfile().extractfile(self.members[name])
+          data = source.read()
+        yield data
+        return
+
+      offset = info.header_offset
+      remaining = info.file_size
+      while remaining > 0:
+        if hasattr(os, 'pread'):
+          chunk = os.pread(self.fd, min(CHUNK_SIZE, remaining), offset)
+        else:
+          with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            chunk = os.read(self.fd, min(CHUNK_SIZE, remaining))
+        if not chunk:
+          raise tarfile.ReadError("Truncated member: %s" % name)
+        offset = offset + len(chunk)
+        remaining = remaining - len(chunk)
+        yield chunk
+
+    def close(self):
+      os.close(self.fd)
+      if self.t is not None:
+        self.t.close()
+
+class SevenZipArchive(MemberArchive):
+    """Member access for CB7 files through py7zr. 7z has no random access
+    into solid blocks, every member is decompressed from start of its block.
+    """
+
+    def __init__(self, filename, outdir, index=None):
+      MemberArchive.__init__(self, filename, outdir, index)
+      self.lock = threading.Lock()
+      self.solid = None
+      if index is not None and index.valid:
+        self.infos = dict(index.members)
+      else:
+        for info in get_7z_infolist(filename):
+          self.infos[info.filename] = info
+      self.drop_unsafe_names()
+
+    def iter_member(self, name):
+      # member is decompressed into memory, nothing is written to outdir
+      with self.lock:
+        with py7zr.SevenZipFile(self.filename) as z:
+          if hasattr(z, 'read'):
+            # py7zr before 1.0
+            source = z.read(targets=[name])[name]
+          else:
+            factory = py7zr.io.BytesIOFactory(self.infos[name].file_size + 1)
+            z.extract(targets=[name], factory=factory)
+            source = factory.get(name)
+          source.seek(0)
+          data = source.read()
+      yield data
+
+    def is_solid(self):
+      if self.solid is None:
+        with py7zr.SevenZipFile(self.filename) as z:
+          self.solid = z.archiveinfo().solid
+      return self.solid
+
+    def extract_all(self, path, names):
+      with py7zr.SevenZipFile(self.filename) as z:
+        z.extract(path=path, targets=names)
+
+class PagePrefetcher():
+    """Extracts pages of book kept open in background, pages nearest to the
+    one being read first, so book can be shown before it is unpacked. Solid
+    archives are extracted by one worker in a single pass instead. When the
+    last worker is done, record is called with bytes and members it
+    extracted and seconds it took. Archive belongs to prefetcher once it is
+    started and is closed by it after stop().
+    """
+
+    def __init__(self, archive, workers, record=None):
+      self.archive = archive
+      self.workers = workers
+      self.record = record
+      self.names = []
+      self.pending = set()
+      self.current = 0
+      self.lock = threading.Lock()
+      self.stopped = False
+      self.threads = []
+      self.running = 0
+      self.started = 0
+      self.bytes_total = 0
+      self.members_total = 0
+
+    def start(self, names, current):
+      # names in page order (None for pages not in archive), current is index into names
+      with self.lock:
+        self.names = names
+        self.pending = set(idx for idx, name in enumerate(names) if name is not None)
+        self.current = current
+        self.started = time.monotonic()
+        if self.archive.is_solid():
+          target = self.run_solid
+          self.running = 1
+        else:
+          target = self.run
+          self.running = max(1, min(self.workers, len(self.pending)))
+      for i in range(self.running):
+        t = threading.Thread(target=target)
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def set_page(self, current):
+      with self.lock:
+        self.current = current
+
+    def next_name(self):
+      with self.lock:
+        if self.stopped or len(self.pending) == 0:
+          return None
+        # following page goes before previous one at the same distance
+        idx = min(self.pending, key=lambda idx: (abs(idx - self.current), idx < self.current))
+        self.pending.discard(idx)
+        return self.names[idx]
+
+    def run(self):
+      name = self.next_name()
+      while name is not None:
+        try:
+          # stored pages are shown from mapped archive, pages extracted on
+          # previous open or shown already are not measured
+          if not self.archive.is_stored(name) and not os.path.isfile(self.archive.member_path(name)):
+            self.archive.extract(name)
+            with self.lock:
+              self.bytes_total = self.bytes_total + self.archive.getinfo(name).file_size
+              self.members_total = self.members_total + 1
+        except Exception as inst:
+          print("Unable to extract page: %s" % inst)
+        name = self.next_name()
+
+      self.worker_done()
+
+    def run_solid(self):
+      with self.lock:
+        names = [self.names[idx] for idx in sorted(self.pending)]
+        self.pending = set()
+      names = [name for name in names if not self.archive.is_stored(name) and not os.path.isfile(self.archive.member_path(name))]
+      try:
+        self.archive.extract_members(names)
+        with self.lock:
+          for name in names:
+            if os.path.isfile(self.archive.member_path(name)):
+              self.bytes_total = self.bytes_total + self.archive.getinfo(name).file_size
+              self.members_total = self.members_total + 1
+      except Exception as inst:
+        print("Unable to extract pages: %s" % inst)
+      self.worker_done()
+
+    def worker_done(self):
+      with self.lock:
+        self.running = self.running - 1
+        finished = self.running == 0
+        close = finished and self.stopped
+      if finished and self.record is not None:
+        try:
+          self.record(self.bytes_total, self.members_total, time.monotonic() - self.started)
+        except Exception as inst:
+          print("Unable to record extraction throughput: %s" % inst)
+      if close:
+        self.archive.close()
+
+    def stop(self):
+      # workers are not waited for, they finish member they are extracting
+      # and last one closes archive
+      with self.lock:
+        self.stopped = True
+        close = self.running == 0
+      if close:
+        self.archive.close()
+      self.threads = []
+
+class ZipExtractor():
+    """Extracts many members at once with a fixed size pool of workers. They
+    share one ZipArchive, which reads members at their offsets with pread and
+    inflates them with zlib, both without holding the GIL, so workers run on
+    separate cores. Progress is reported to progress_queue as (extracted,
+    total) tuples and completion by done event.
+    """
+
+    def __init__(self, filename, outdir, workers, progress_queue=None, index=None):
+      self.filename = filename
+      self.outdir = outdir
+      self.workers = workers
+      self.progress_queue = progress_queue
+      self.archive = ZipArchive(filename, outdir, index)
+      self.done = threading.Event()
+      self.lock = threading.Lock()
+      self.errors = []
+      self.extracted = 0
+      self.total = 0
+
+    def start(self, names):
+      names = [name for name in names if name in self.archive.infos]
+      self.total = len(names)
+      if self.total == 0:
+        self.archive.close()
+        self.done.set()
+        return
+
+      # create directories up front, workers would race on makedirs otherwise;
+      # unsafe names are not in archive infos, they got no further than here
+      directories = set()
+      for name in names:
+        directories.add(os.path.dirname(self.archive.member_path(name)))
+      for directory in sorted(directories):
+        if not os.path.exists(directory):
+          os.makedirs(directory, 0o700)
+
+      # largest members first, so no worker is left with a big one at the end
+      names = sorted(names, key=lambda name: self.archive.getinfo(name).compress_size, reverse=True)
+      executor = ThreadPoolExecutor(max_workers=max(1, min(self.workers, self.total)))
+      for name in names:
+        future = executor.submit(self.extract, name)
+        future.add_done_callback(self.member_done)
+      executor.shutdown(wait=False)
+
+    def wait(self):
+      self.done.wait()
+      return self.errors
+
+    def extract(self, name):
+      self.archive.extract(name)
+      return name
+
+    def member_done(self, future):
+      with self.lock:
+        self.extracted = self.extracted + 1
+        if future.exception() is not None:
+          self.errors.append(future.exception())
+        if self.progress_queue is not None:
+          self.progress_queue.put((self.extracted, self.total))
+        finished = self.extracted == self.total
+
+      if finished:
+        self.archive.close()
+        self.done.set()
+
+class ArchivePool():
+    """Archives referenced by zip: image URIs, kept open by path so their
+    central directory is read only once. Least recently used archive is
+    closed when more than size are open. Member content read through the
+    pool is remembered up to cache_size bytes.
+    """
+
+    def __init__(self, size, cache_size):
+      self.size = size
+      self.cache_size = cache_size
+      self.lock = threading.Lock()
+      # path -> ((size, mtime, outdir), ZipArchive)
+      self.archives = OrderedDict()
+      # (path, name) -> bytes
+      self.members = OrderedDict()
+      self.cached_bytes = 0
+
+    def get_archive(self, filename, outdir):
+      # called with lock held
+      filename = os.path.abspath(filename)
+      stat = os.stat(filename)
+      key = (stat.st_size, stat.st_mtime, outdir)
+      if filename in self.archives:
+        archive_key, archive = self.archives[filename]
+        if archive_key == key:
+          self.archives.move_to_end(filename)
+          return archive
+        # archive changed on disk since it was opened
+        self.drop(filename)
+
+      archive = ZipArchive(filename, outdir)
+      self.archives[filename] = (key, archive)
+      while len(self.archives) > self.size:
+        self.drop(next(iter(self.archives)))
+      return archive
+
+    def drop(self, filename):
+      key, archive = self.archives.pop(filename)
+      archive.close()
+      for member in [member for member in self.members if member[0] == filename]:
+        self.cached_bytes = self.cached_bytes - len(self.members.pop(member))
+
+    def read(self, filename, name, outdir):
+      with self.lock:
+        archive = self.get_archive(filename, outdir)
+        member = (archive.filename, name)
+        if member in self.members:
+          self.members.move_to_end(member)
+          return self.members[member]
+
+        data = archive.read(name)
+        if len(data) <= self.cache_size:
+          self.members[member] = data
+          self.cached_bytes = self.cached_bytes + len(data)
+          while self.cached_bytes > self.cache_size:
+            self.cached_bytes = self.cached_bytes - len(self.members.popitem(last=False)[1])
+        return data
+
+    def extract(self, filename, name, outdir):
+      with self.lock:
+        return self.get_archive(filename, outdir).extract(name)
+
+    def close(self):
+      with self.lock:
+        for filename in list(self.archives):
+          self.drop(filename)
+
+archive_pool = ArchivePool(4, 16 * 1024 * 1024)
+
+# function to tell if member name stays inside directory it is extracted to
+def is_safe_name(name):
+    if os.path.isabs(name) or name.startswith(('/', '\\')) or os.path.splitdrive(name)[0] != '':
+      return False
+    return '..' not in name.replace('\\', '/').split('/')
+
+# function to list tar members as ZipInfo records, header_offset is start of member data
+def get_tar_infolist(filename):
+    infolist = []
+    with tarfile.open(filename) as t:
+      for member in t.getmembers():
+        name = get_tar_member_name(member)
+        if name.rstrip('/') in ('', '.') or not (member.isdir() or member.isfile()):
+          continue
+        info = zipfile.ZipInfo(name)
+        info.header_offset = member.offset_data
+        info.file_size = member.size
+        info.compress_size = member.size
+        # tar has no checksum of member data, index stores one for every member
+        info.CRC = 0
+        infolist.append(info)
+    return infolist
+
+# function to name tar member the way zip would, without leading ./ and with / after directories
+def get_tar_member_name(member):
+    name = member.name
+    while name.startswith('./'):
+      name = name[2:]
+    if member.isdir():
+      name = name.rstrip('/') + '/'
+    return name
+
+# function to list 7z members as ZipInfo records
+def get_7z_infolist(filename):
+    infolist = []
+    with py7zr.SevenZipFile(filename) as z:
+      for member in z.list():
+        if member.is_directory:
+          info = zipfile.ZipInfo(member.filename.rstrip('/') + '/')
+        else:
+          info = zipfile.ZipInfo(member.filename)
+        info.file_size = member.uncompressed
+        info.compress_size = member.compressed or 0
+        info.CRC = member.crc32 or 0
+        infolist.append(info)
+    return infolist
+
+# function to open archive of given type with on demand member access
+def open_archive(file_type, filename, outdir, index=None):
+    if file_type == 'RAR':
+      return RarArchive(filename, outdir, index)
+    elif file_type == 'TAR':
+      return TarArchive(filename, outdir, index)
+    elif file_type == '7Z':
+      return SevenZipArchive(filename, outdir, index)
+    return ZipArchive(filename, outdir, index)
+
+# function to read image dimensions from header, data comes in chunks and is
+# read only until dimensions are found, returns None for unknown formats
+def get_image_size(chunks):
+    header = b''
+    for chunk in chunks:
+      header = header + chunk
+      try:
+        size = parse_image_header(header)
+      except (ValueError, struct.error):
+        return None
+      if size is not None or len(header) >= IMAGE_HEADER_LIMIT:
+        return size
+    return None
+
+# function to parse image dimensions, returns None when more data is needed
+# and raises ValueError when format is not known
+def parse_image_header(header):
+    if len(header) < 30:
+      return None
+
+    if header[:8] == b'\x89PNG\r\n\x1a\n':
+      return struct.unpack('>2L', header[16:24])
+    elif header[:6] in (b'GIF87a', b'GIF89a'):
+      return struct.unpack('<2H', header[6:10])
+    elif header[:2] == b'BM':
+      if struct.unpack('<L', header[14:18])[0] == 12:
+        return struct.unpack('<2H', header[18:22])
+      width, height = struct.unpack('<2l', header[18:26])
+      return width, abs(height)
+    elif header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+      chunk_type = header[12:16]
+      if chunk_type == b'VP8 ':
+        width, height = struct.unpack('<2H', header[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+      elif chunk_type == b'VP8L':
+        bits = struct.unpack('<L', header[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+      elif chunk_type == b'VP8X':
+        return (int.from_bytes(header[24:27], 'little') + 1, int.from_bytes(header[27:30], 'little') + 1)
+      raise ValueError("Unknown WebP chunk")
+    elif header[:2] == b'\xff\xd8':
+      # walk JPEG segments up to start of frame
+      pos = 2
+      while pos + 9 < len(header):
+        if header[pos] != 0xFF:
+          raise ValueError("Bad JPEG marker")
+        marker = header[pos + 1]
+        if marker == 0xFF:
+          pos = pos + 1
+        elif marker in JPEG_SOF_MARKERS:
+          height, width = struct.unpack('>2H', header[pos + 5:pos + 9])
+          return width, height
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD9:
+          pos = pos + 2
+        else:
+          pos = pos + 2 + struct.unpack('>H', header[pos + 2:pos + 4])[0]
+      return None
+    raise ValueError("Unknown image format")
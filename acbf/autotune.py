@@ -0,0 +1,150 @@
+"""autotune.py - extraction concurrency tuned from measured throughput (CONFIG_DIR/extraction.xml).
+
+Copyright (C) 2011-2024 Robert Kubik
+https://github.com/ACBF-Advanced-Comic-Book-Format
+"""
+
+# -------------------------------------------------------------------------
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# -------------------------------------------------------------------------
+
+
+import os.path
+import sys
+import platform
+import zipfile
+import lxml.etree as xml
+
+try:
+  from . import constants
+except Exception:
+  import constants
+
+# worker counts the tuner moves between
+WORKER_LEVELS = [1, 2, 3, 4, 6, 8, 12, 16, 24, 32]
+# weight of the newest measurement in the running average
+SMOOTHING = 0.3
+# opens with fewer members are too short to say anything about throughput
+MIN_MEMBERS = 10
+
+class ExtractionTuner():
+
+  def __init__(self, config_dir):
+      self.tuner_file_path = os.path.join(config_dir, 'extraction.xml')
+      self.device = sys.platform + '-' + platform.machine() + '-' + str(os.cpu_count() or 1)
+      self.load_model()
+
+  def create_new_tree(self):
+      self.tree = xml.Element("extraction")
+
+      version = xml.SubElement(self.tree, "version")
+      version.text = constants.VERSION
+
+  def load_model(self):
+      try:
+        self.tree = xml.parse(source = self.tuner_file_path).getroot()
+      except Exception:
+        self.create_new_tree()
+
+  def save_model(self):
+      # written next to model first, interrupted write leaves previous model in place
+      try:
+        f = open(self.tuner_file_path + '.part', 'w')
+        f.write(xml.tostring(self.tree, encoding='unicode', pretty_print=True))
+        f.close()
+        os.replace(self.tuner_file_path + '.part', self.tuner_file_path)
+      except OSError as inst:
+        print("Unable to save extraction model: %s" % inst)
+
+  def get_levels(self, compression):
+      # measured worker counts for this device and compression -> (bytes/s, members/s)
+      levels = {}
+      for device in self.tree.findall("device"):
+        if device.get("id") == self.device:
+          for measured in device.findall("compression"):
+            if measured.get("type") == compression:
+              for workers in measured.findall("workers"):
+                levels[int(workers.get("count"))] = (float(workers.get("bytes_per_second")), float(workers.get("members_per_second")))
+      return levels
+
+  def get_workers(self, compression):
+      levels = self.get_levels(compression)
+      max_workers = 2 * (os.cpu_count() or 1)
+      candidates = [level for level in WORKER_LEVELS if level <= max_workers]
+
+      if len(levels) == 0:
+        # start from one worker per core
+        start = [level for level in candidates if level <= (os.cpu_count() or 1)]
+        return start[-1]
+
+      best = max(levels, key=lambda level: levels[level][0])
+      if best not in candidates:
+        return best
+
+      # try untested neighbours of the fastest level, otherwise stay there
+      idx = candidates.index(best)
+      for neighbour in candidates[idx + 1:idx + 2] + candidates[max(idx - 1, 0):idx]:
+        if neighbour not in levels:
+          return neighbour
+      return best
+
+  def record(self, compression, workers, bytes_total, members_total, seconds):
+      if members_total < MIN_MEMBERS or seconds <= 0:
+        return
+
+      bytes_per_second = bytes_total / seconds
+      members_per_second = members_total / seconds
+
+      device_element = None
+      for device in self.tree.findall("device"):
+        if device.get("id") == self.device:
+          device_element = device
+      if device_element is None:
+        device_element = xml.SubElement(self.tree, "device", id=self.device)
+
+      compression_element = None
+      for measured in device_element.findall("compression"):
+        if measured.get("type") == compression:
+          compression_element = measured
+      if compression_element is None:
+        compression_element = xml.SubElement(device_element, "compression", type=compression)
+
+      workers_element = None
+      for measured in compression_element.findall("workers"):
+        if measured.get("count") == str(workers):
+          workers_element = measured
+      if workers_element is None:
+        workers_element = xml.SubElement(compression_element, "workers", count=str(workers), samples="0",
+                                         bytes_per_second=str(bytes_per_second), members_per_second=str(members_per_second))
+
+      # running average, so one slow open does not throw away what was learned
+      samples = int(workers_element.get("samples"))
+      if samples > 0:
+        bytes_per_second = SMOOTHING * bytes_per_second + (1 - SMOOTHING) * float(workers_element.get("bytes_per_second"))
+        members_per_second = SMOOTHING * members_per_second + (1 - SMOOTHING) * float(workers_element.get("members_per_second"))
+      workers_element.set("bytes_per_second", str(round(bytes_per_second, 1)))
+      workers_element.set("members_per_second", str(round(members_per_second, 2)))
+      workers_element.set("samples", str(samples + 1))
+
+      self.save_model()
+
+# function to name compression used by most of the archive data
+def get_compression_type(infolist):
+    names = {zipfile.ZIP_STORED: 'stored', zipfile.ZIP_DEFLATED: 'deflate', zipfile.ZIP_BZIP2: 'bzip2', zipfile.ZIP_LZMA: 'lzma'}
+    sizes = {}
+    for info in infolist:
+      compression = names.get(info.compress_type, 'other')
+      sizes[compression] = sizes.get(compression, 0) + info.compress_size
+    if len(sizes) == 0:
+      return 'stored'
+    return max(sizes, key=lambda compression: sizes[compression])
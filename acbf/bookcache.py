@@ -0,0 +1,255 @@
+"""bookcache.py - extracted books kept between opens (TEMP_DIR/Books).
+
+Copyright (C) 2011-2024 Robert Kubik
+https://github.com/ACBF-Advanced-Comic-Book-Format
+"""
+
+# -------------------------------------------------------------------------
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# -------------------------------------------------------------------------
+
+
+import os
+import sys
+import hashlib
+import shutil
+import threading
+import uuid
+
+CACHE_DIR_NAME = 'Books'
+# removed files are moved here and deleted in background
+TRASH_DIR_NAME = 'Trash'
+COMPLETE_MARKER = '.complete'
+# size of book directory in bytes, so eviction does not walk cached books
+SIZE_FILE = '.size'
+# bytes read from start and end of a file to fingerprint it
+FINGERPRINT_BLOCK = 64 * 1024
+
+class BookCache():
+    """Each book is extracted into its own directory named by fingerprint of
+    the archive content. Least recently opened books are removed when the
+    cache grows over budget (in bytes), in background by reaper. Size of each
+    book is kept in its directory, books without it are measured once.
+    Archive member indexes in index_dir count against the same budget and
+    are removed the same way.
+    """
+
+    def __init__(self, tempdir, budget, index_dir=None):
+      self.cache_dir = os.path.join(tempdir, CACHE_DIR_NAME)
+      self.trash_dir = os.path.join(tempdir, TRASH_DIR_NAME)
+      self.index_dir = index_dir
+      self.budget = budget
+      if not os.path.exists(self.cache_dir):
+        os.makedirs(self.cache_dir, 0o700)
+
+    def get_book_dir(self, filename):
+      book_dir = os.path.join(self.cache_dir, get_fingerprint(filename))
+      if not os.path.exists(book_dir):
+        os.makedirs(book_dir, 0o700)
+      # directory modification time is what eviction orders books by
+      os.utime(book_dir, None)
+      if not self.is_complete(book_dir):
+        # book extracted on demand grows while it is read, it is measured again later
+        remove_path(os.path.join(book_dir, SIZE_FILE))
+      return book_dir
+
+    def is_complete(self, book_dir):
+      return os.path.isfile(os.path.join(book_dir, COMPLETE_MARKER))
+
+    def set_complete(self, book_dir):
+      open(os.path.join(book_dir, COMPLETE_MARKER), 'w').close()
+      set_book_size(book_dir, get_dir_size(book_dir))
+
+    def evict(self, keep):
+      # keep are paths of book directory and member index of the book being opened
+      reaper.schedule(self.evict_books, keep)
+
+    def evict_books(self, keep):
+      books = []
+      total_size = 0
+      for entry in os.scandir(self.cache_dir):
+        if entry.is_dir():
+          size = get_book_size(entry.path, entry.path not in keep)
+          books.append((entry.stat().st_mtime, entry.path, size))
+          total_size = total_size + size
+      if self.index_dir is not None and os.path.isdir(self.index_dir):
+        for entry in os.scandir(self.index_dir):
+          if entry.is_file() and entry.name.endswith('.xml'):
+            stat = entry.stat()
+            books.append((stat.st_mtime, entry.path, stat.st_size))
+            total_size = total_size + stat.st_size
+
+      for mtime, path, size in sorted(books):
+        if total_size <= self.budget:
+          break
+        if path in keep:
+          continue
+        print("Removing cached entry:", path)
+        move_to_trash(path, self.trash_dir)
+        total_size = total_size - size
+
+# function to identify archive by its content, so copies of the same file share cache
+def get_fingerprint(filename):
+    size = os.path.getsize(filename)
+    sha = hashlib.sha1(str(size).encode('ascii'))
+    f = open(filename, 'rb')
+    sha.update(f.read(FINGERPRINT_BLOCK))
+    if size > FINGERPRINT_BLOCK:
+      f.seek(max(FINGERPRINT_BLOCK, size - FINGERPRINT_BLOCK))
+      sha.update(f.read(FINGERPRINT_BLOCK))
+    f.close()
+    return sha.hexdigest()
+
+# function to identify document read into memory by all of its content, for
+# documents that have no file of their own to take size and modification time from
+def get_data_fingerprint(data):
+    return hashlib.sha1(data).hexdigest()
+
+# function to get size of cached book from its size file, book without one is
+# measured and size is stored when store is set
+def get_book_size(book_dir, store):
+    try:
+      with open(os.path.join(book_dir, SIZE_FILE)) as f:
+        return int(f.read())
+    except (OSError, ValueError):
+      pass
+    size = get_dir_size(book_dir)
+    if store:
+      set_book_size(book_dir, size)
+    return size
+
+def set_book_size(book_dir, size):
+    try:
+      with open(os.path.join(book_dir, SIZE_FILE), 'w') as f:
+        f.write(str(size))
+    except OSError as inst:
+      print("Exception: %s" % inst)
+
+def get_dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+      for f in files:
+        try:
+          size = size + os.path.getsize(os.path.join(root, f))
+        except OSError:
+          pass
+    return size
+
+class Reaper():
+    """Deletes whatever is moved into trash directories and runs scheduled
+    cache maintenance, in a background thread with low priority. Trash left
+    over after a crash is deleted the next time anything is moved there.
+    """
+
+    def __init__(self):
+      self.lock = threading.Lock()
+      self.trash_dirs = set()
+      self.tasks = []
+      self.thread = None
+
+    def reap(self, trash_dir):
+      with self.lock:
+        self.trash_dirs.add(trash_dir)
+        self.start()
+
+    def schedule(self, task, *args):
+      with self.lock:
+        self.tasks.append((task, args))
+        self.start()
+
+    def start(self):
+      # called with lock held
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+      set_low_priority()
+      # entries that could not be deleted (open elsewhere, no permission) are
+      # not tried again by this thread, only next time reaper is started
+      failed = set()
+      while True:
+        with self.lock:
+          tasks = self.tasks
+          self.tasks = []
+          entries = []
+          for trash_dir in self.trash_dirs:
+            if os.path.isdir(trash_dir):
+              entries.extend(path for path in (os.path.join(trash_dir, entry) for entry in os.listdir(trash_dir))
+                             if path not in failed)
+          if len(tasks) == 0 and len(entries) == 0:
+            self.thread = None
+            return
+        for task, args in tasks:
+          try:
+            task(*args)
+          except Exception as inst:
+            print("Exception: %s" % inst)
+        for path in entries:
+          remove_path(path)
+          if os.path.lexists(path):
+            print("Unable to remove:", path)
+            failed.add(path)
+
+reaper = Reaper()
+
+# function to move file or directory out of the way at once, reaper deletes it later
+def move_to_trash(path, trash_dir):
+    try:
+      if not os.path.exists(trash_dir):
+        os.makedirs(trash_dir, 0o700, exist_ok=True)
+      os.replace(path, os.path.join(trash_dir, uuid.uuid4().hex))
+    except OSError as inst:
+      print("Exception: %s" % inst)
+      remove_path(path)
+    reaper.reap(trash_dir)
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+      shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+      try:
+        os.unlink(path)
+      except OSError:
+        pass
+
+# function to lower priority of current thread, only threads on linux (android) have their own
+def set_low_priority():
+    if sys.platform.startswith('linux'):
+      try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+      except Exception:
+        pass
+
+# function to clear temp directory, cached books are left alone
+def clear_temp_dir(tempdir):
+    if not os.path.isdir(tempdir):
+      return
+    trash_dir = os.path.join(tempdir, TRASH_DIR_NAME)
+    for entry in os.listdir(tempdir):
+      if entry in (CACHE_DIR_NAME, TRASH_DIR_NAME):
+        continue
+      move_to_trash(os.path.join(tempdir, entry), trash_dir)
+    # trash of previous run is deleted too
+    reaper.reap(trash_dir)
+
+# function to clear directory, trash directory is next to it
+def clear_dir(path):
+    if not os.path.isdir(path):
+      return
+    trash_dir = os.path.join(os.path.dirname(path), TRASH_DIR_NAME)
+    for entry in os.listdir(path):
+      move_to_trash(os.path.join(path, entry), trash_dir)
+    # trash left by earlier clear is deleted even when directory is empty now
+    reaper.reap(trash_dir)
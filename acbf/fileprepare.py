@@ -21,25 +21,33 @@ https://github.com/ACBF-Advanced-Comic-Book-Format
 
 
 import os
+import io
 import stat
-import shutil
+import tarfile
 import zipfile
 import lxml.etree as xml
 from PIL import Image
 import subprocess
-import threading
 import time
+import functools
 import patoolib
 from kivy.app import App
+from concurrent.futures import ThreadPoolExecutor
 
 try:
   from . import constants
   from . import preferences
   from . import acbfdocument
+  from . import archive
+  from . import autotune
+  from . import bookcache
 except Exception:
   import constants
   import preferences
   import acbfdocument
+  import archive
+  import autotune
+  import bookcache
 
 class FilePrepare():
     
@@ -47,138 +55,139 @@ class FilePrepare():
       print("fileprepare")
       
       # try to load unrar lib
-      for unrar_lib in ['arm64-v8a', 'armeabi-v7a']:
-        lib_path = os.path.join(App.get_running_app().user_data_dir, 'app', 'unrar', unrar_lib, 'libunrardyn.so')
-        os.environ['UNRAR_LIB_PATH'] = lib_path
-        try:
-          from unrar import rarfile
-          is_rarfile = True
-          break
-        except Exception as inst:
-          is_rarfile = False
-          print('Failed to load library: ' + lib_path)
-          print("Exception: %s" % inst)
+      rarfile = load_unrar()
+      is_rarfile = rarfile is not None
 
       self._window = window
       self.filename = str(filename)
       self.tempdir = tempdir
+      self.archive = None
 
+      # release archive kept open by previously prepared book, prefetcher closes it when its workers are done
+      if self._window.prefetcher is not None:
+        self._window.prefetcher.stop()
+        self._window.prefetcher = None
+      elif self._window.archive is not None:
+        self._window.archive.close()
+      self._window.archive = None
+
+      # archive members are listed from persisted index when the file did not change
       file_type = None
-      if zipfile.is_zipfile(self.filename):
-        file_type = 'ZIP'
-      elif self.filename[-4:].upper() == 'ACBF':
-        file_type = 'ACBF'
-      elif self.filename[-4:].upper() == '.CBR':
-        file_type = 'RAR'
-
-      # clear temp directory
-      for root, dirs, files in os.walk(self.tempdir):
-        for f in files:
-          os.unlink(os.path.join(root, f))
-        for d in dirs:
-          shutil.rmtree(os.path.join(root, d))
+      index = None
+      if self.filename[-4:].upper() != 'ACBF':
+        index = archive.MemberIndex(os.path.join(App.get_running_app().user_data_dir, 'Index'), self.filename)
+        file_type = index.file_type
+
+      if file_type is None:
+        file_type = get_file_type(self.filename, index, rarfile)
+      self.index = index
+
+      # members are accessed one by one for archives that can list them
+      member_access = has_member_access(file_type, rarfile)
+
+      is_cached = False
+      if prepare_type == 'book':
+        # extracted books are kept in cache, reopening one skips extraction
+        book_cache = bookcache.BookCache(tempdir, int(App.get_running_app().config.get('general', 'cache_size')) * 1024 * 1024,
+                                         os.path.join(App.get_running_app().user_data_dir, 'Index'))
+        self.tempdir = book_cache.get_book_dir(self.filename)
+        keep = [self.tempdir]
+        if index is not None:
+          keep.append(index.index_file_path)
+        book_cache.evict(keep)
+        is_cached = book_cache.is_complete(self.tempdir)
+      else:
+        # clear temp directory
+        bookcache.clear_dir(self.tempdir)
+      self.book_dir = self.tempdir
+      self._window.book_dir = self.tempdir
 
       if file_type == 'ACBF':
-        return_filename = os.path.join(self.tempdir, os.path.basename(self.filename))
-        try:
-          shutil.copy(self.filename, return_filename)
-        except:
-          pass
+        # opened in place, decoded binaries and fonts go to book directory
+        return_filename = self.filename
         self._window.prepared_file = return_filename
+        self._window.prepared_tree = None
       else:
-        if file_type == 'ZIP':
+        if member_access and prepare_type == 'book' and App.get_running_app().config.get('general', 'lazy_extract') == '1':
+          # keep archive open, pages are extracted when they are shown
+          self.archive = archive.open_archive(file_type, self.filename, self.tempdir, index)
+          self._window.archive = self.archive
+          essential_files = []
+          for f in self.archive.namelist():
+            if f[-4:].upper() in ('ACBF', '.XML') + archive.FONT_EXTENSIONS:
+              essential_files.append(f)
+
+          for idx, f in enumerate(essential_files):
+            self.archive.extract(f)
+            self._window.loading_progress.put((idx + 1, len(essential_files)))
+          zip_files = index.pages
+
+          # rest of the pages is extracted in background once the book is open
+          workers = 1
+          record = None
+          if file_type == 'ZIP':
+            # background extraction is measured for the tuner as well
+            tuner = autotune.ExtractionTuner(App.get_running_app().user_data_dir)
+            compression = autotune.get_compression_type(index.members.values())
+            workers = tuner.get_workers(compression)
+            record = functools.partial(tuner.record, compression, workers)
+          self._window.prefetcher = archive.PagePrefetcher(self.archive, workers, record)
+        elif file_type == 'ZIP' and prepare_type == 'book' and is_cached:
+          print("Book found in cache:", self.tempdir)
+        elif file_type == 'ZIP' and prepare_type == 'book':
           # extract files from CBZ into DATA_DIR
-          z = zipfile.ZipFile(self.filename)
-          if prepare_type == 'book':
-            # thread count handling
-            threads_status = App.get_running_app().config.get('general', 'threads').split(',')[0]
-            threads = int(App.get_running_app().config.get('general', 'threads').split(',')[1])
-            threads_count = int(App.get_running_app().config.get('general', 'threads').split(',')[2])
-            threads_delay = float(App.get_running_app().config.get('general', 'threads').split(',')[3])
-            #print("Threads before:", threads_status, threads, threads_count, threads_delay, len(z.namelist()))
-
-            if (threads_status == "True" and threads_count > 5 and threads_delay > 0.1 and threads > 50):
-              threads = 30
-              threads_delay = threads_delay - 0.1
-              threads_count = 0
-            elif (threads_status == "True" and threads_count > 5):
-              threads = threads + 1
-              threads_count = 0
-            elif (threads_status != "True" and threads >= 20):
-              threads = threads - 10
-              threads_count = 0
-            elif threads_status != "True":
-              threads_delay = threads_delay + 0.1
-              threads = 30
-              threads_count = 0
-            elif len(z.namelist()) > threads:
-              threads_count = threads_count + 1
-
-            thread_setting = 'False,' + str(threads) + ',' + str(threads_count) + ',' + str(round(threads_delay, 1))
-            #print("Threads after:", thread_setting)
-            App.get_running_app().config.set('general', 'threads', thread_setting)
-            App.get_running_app().config.write()
-
-            self._window.loading_book_dialog.ids.loading_progress_bar.max = len(z.namelist())
-
-            #extract directories first to avoid extract mkdir error in threads
-            folders_inside = []
-            for idx, f in enumerate(z.infolist()):
-              if '/' in f.filename:
-                if f.filename[:f.filename.rfind("/")] not in folders_inside:
-                  folders_inside.append(f.filename[:f.filename.rfind("/")])
-                  z.extract(f, self.tempdir)
-            active_threads = threading.active_count()
-            for idx, f in enumerate(z.namelist()):
-              while threading.active_count() > threads: # keep it low
-                time.sleep(threads_delay)
-              t = threading.Thread(target=self.extract_file, args = (z, f, prepare_type))
-              t.daemon = True
-              t.start()
-
-            while threading.active_count() > active_threads:
-              time.sleep(0.5)
-          else:
-            zip_files = []
-            metadata_file = ''
-            coverpage_file = ''
-            for file_in_zip in z.infolist():
-              if file_in_zip.filename[-4:].upper() == 'ACBF':
-                # extract ACBF
-                self.extract_file(z, file_in_zip.filename, prepare_type)
-                # extract coverpage
-                metadata_file = str(os.path.join(self.tempdir, file_in_zip.filename))
-                acbf_doc =  acbfdocument.ACBFDocument(self, metadata_file)
-
-                try:
-                  self.extract_file(z, acbf_doc.coverpage.replace(self.tempdir + '/', ''), prepare_type)
-                except:
-                  print("extract failed - probably internal image")
-
-              elif file_in_zip.filename[-4:].upper() == '.XML':
-                # extract XML
-                self.extract_file(z, file_in_zip.filename, prepare_type)
-              elif self.filename[-4:].upper() == '.ACV':
-                self.extract_file(z, file_in_zip.filename, prepare_type)
-            for file_in_zip in z.infolist():
-              if file_in_zip.filename[-4:].upper() in ('.JPG', '.PNG', '.GIF', 'WEBP', '.BMP', 'JPEG'):
-                zip_files.append(str(file_in_zip.filename))
-
-            # extract coverpage
-            if len(zip_files) > 0:
-              safe_zip_files = []
-              for f in zip_files:
-                safe_zip_files.append(f)
-              
-              for f in zip_files:
-                if f == sorted(safe_zip_files)[0]:
-                  self.extract_file(z, f, prepare_type)
-          
+          # concurrency picked from throughput measured on previous opens
+          tuner = autotune.ExtractionTuner(App.get_running_app().user_data_dir)
+          compression = autotune.get_compression_type(index.members.values())
+          workers = tuner.get_workers(compression)
+          started = time.monotonic()
+
+          extractor = archive.ZipExtractor(self.filename, self.tempdir, workers, self._window.loading_progress, index)
+          extractor.start(index.namelist())
+          errors = extractor.wait()
+          for error in errors:
+            print("Exception: %s" % error)
+          tuner.record(compression, workers, sum(info.file_size for info in index.members.values()), len(index.members), time.monotonic() - started)
+          if len(errors) == 0:
+            book_cache.set_complete(self.tempdir)
+        elif member_access and prepare_type != 'book':
+          # extract metadata and coverpage only
+          self.archive = archive.open_archive(file_type, self.filename, self.tempdir, index)
+          zip_files = index.pages
+          acbf_in_archive = False
+          for f in self.archive.namelist():
+            if f[-4:].upper() == 'ACBF':
+              # coverpage is extracted on demand while document loads it
+              acbf_in_archive = True
+              acbfdocument.ACBFDocument(self, self.archive.extract(f))
+            elif f[-4:].upper() == '.XML':
+              self.archive.extract(f)
+
+          if not acbf_in_archive and index.cover != '':
+            self.archive.extract(index.cover)
+
+        elif is_cached:
+          print("Book found in cache:", self.tempdir)
         elif file_type == 'RAR' and is_rarfile:
+          # book mode with on demand extraction switched off
           r = rarfile.RarFile(self.filename)
           r.extractall(self.tempdir)
+          if prepare_type == 'book':
+            book_cache.set_complete(self.tempdir)
+        elif member_access:
+          # book mode with on demand extraction switched off
+          self.archive = archive.open_archive(file_type, self.filename, self.tempdir, index)
+          names = self.archive.namelist()
+          for idx, f in enumerate(names):
+            self.archive.extract(f)
+            self._window.loading_progress.put((idx + 1, len(names)))
+          zip_files = index.pages
+          book_cache.set_complete(self.tempdir)
         else:
+          # formats without reader of their own
           patoolib.extract_archive(archive=self.filename, outdir=self.tempdir)
+          if prepare_type == 'book':
+            book_cache.set_complete(self.tempdir)
 
         # rename to safe filenames
         #for root, dirs, files in os.walk(self.tempdir):
@@ -189,6 +198,7 @@ class FilePrepare():
         #    os.rename(os.path.join(root, f), os.path.join(root, f).encode('ascii', 'replace').replace('?', '_'))
 
         # check if there's ACBF file inside
+        self._window.prepared_tree = None
         acbf_found = False
         for datafile in os.listdir(self.tempdir):
           if datafile[-4:].upper() == 'ACBF':
@@ -197,150 +207,319 @@ class FilePrepare():
 
         if not acbf_found:
           # create dummy acbf file
-          tree = xml.Element("ACBF", xmlns="http://www.fictionbook-lib.org/xml/acbf/1.0")
-          metadata = xml.SubElement(tree, "meta-data")
-          bookinfo = xml.SubElement(metadata, "book-info")
-          coverpage = xml.SubElement(bookinfo, "coverpage")
-          cover_image = ''
           all_files = []
-          files_to_elements = {}
-          publishinfo = xml.SubElement(metadata, "publish-info")
-          docinfo = xml.SubElement(metadata, "document-info")
-          body = xml.SubElement(tree, "body")
-
-          if os.path.isfile(os.path.join(self.tempdir, "comic.xml")):
-            is_acv_file = True
-          else:
-            is_acv_file = False
-
-          if file_type == 'ZIP' and prepare_type != 'book':
+          if self.archive is not None:
             for zfile in zip_files:
               all_files.append(zfile)
           else:
             for root, dirs, files in os.walk(self.tempdir):
               for f in files:
                 all_files.append(os.path.join(root, f)[len(self.tempdir) + 1:])
-          
-          for datafile in sorted(all_files):
-            if datafile[-4:].upper() in ('.JPG', '.PNG', '.GIF', 'WEBP', '.BMP', 'JPEG'):
-              if cover_image == '':
-                # insert coverpage
-                cover_image = xml.SubElement(coverpage, "image", href=datafile)
-                files_to_elements[os.path.basename(datafile)[:-4]] = cover_image
-              else:
-                # insert normal page
-                if is_acv_file and "/" not in datafile:
-                  page = xml.SubElement(body, "page")
-                  image = xml.SubElement(page, "image", href=datafile)
-                  files_to_elements[os.path.basename(datafile)[:-4]] = image
-                elif not is_acv_file:
-                  page = xml.SubElement(body, "page")
-                  image = xml.SubElement(page, "image", href=datafile)
-
-          # check for ACV's comic.xml
-          if is_acv_file:
-            acv_tree = xml.parse(source = os.path.join(self.tempdir, "comic.xml"))
-
-            if acv_tree.getroot().get("bgcolor") != None:
-              body.set("bgcolor", acv_tree.getroot().get("bgcolor"))
-
-            if acv_tree.getroot().get("title") != None:
-              book_title = xml.SubElement(bookinfo, "book-title")
-              book_title.text = acv_tree.getroot().get("title")
-
-            images = acv_tree.find("images")
-            pattern_length = len(images.get("indexPattern"))
-            pattern_format = images.get("namePattern").replace("@index", "%%0%dd" % pattern_length)
-            for screen in acv_tree.findall("screen"):
-              element = files_to_elements[pattern_format % int(screen.get("index"))]
-              xsize, ysize = Image.open(os.path.join(self.tempdir, element.get('href'))).size
-              for frame in screen:
-                x1, y1, w, h = map(float, frame.get("relativeArea").split(" "))
-                ix1 = int(xsize * x1)
-                ix2 = int(xsize * (x1 + w))
-                iy1 = int(ysize * y1)
-                iy2 = int(ysize * (y1 + h))
-                envelope = "%d,%d %d,%d %d,%d %d,%d" % (ix1, iy1, ix2, iy1, ix2, iy2, ix1, iy2)
-                frame_elt = xml.SubElement(element.getparent(), "frame", points=envelope)
-                if frame.get("bgcolor") != None:
-                  frame_elt.set("bgcolor", frame.get("bgcolor"))
-
-          # check if there's ComicInfo.xml file inside
-          elif os.path.isfile(os.path.join(self.tempdir, "ComicInfo.xml")):
-            # load comic book information from ComicInfo.xml
-            comicinfo_tree = xml.parse(source = os.path.join(self.tempdir, "ComicInfo.xml"))
-
-            for author in ["Writer", "Penciller", "Inker", "Colorist", "CoverArtist", "Adapter", "Letterer"]:
-              if comicinfo_tree.find(author) != None:
-                author_element = xml.SubElement(bookinfo, "author", activity=author)
-                first_name = xml.SubElement(author_element, "first-name")
-                first_name.text = comicinfo_tree.find(author).text.split(' ')[0]
-                if len(comicinfo_tree.find(author).text.split(' ')) > 2:
-                  middle_name = xml.SubElement(author_element, "middle-name")
-                  middle_name.text = ''
-                  for i in range(len(comicinfo_tree.find(author).text.split(' '))):
-                    if i > 0 and i < (len(comicinfo_tree.find(author).text.split(' ')) - 1):
-                      middle_name.text = middle_name.text + ' ' + comicinfo_tree.find(author).text.split(' ')[i]
-                last_name = xml.SubElement(author_element, "last-name")
-                last_name.text = comicinfo_tree.find(author).text.split(' ')[-1]
-
-            if comicinfo_tree.find("Title") != None:
-              book_title = xml.SubElement(bookinfo, "book-title")
-              book_title.text = comicinfo_tree.find("Title").text
-
-            if comicinfo_tree.find("Genre") != None:
-              for one_genre in comicinfo_tree.find("Genre").text.split(', '):
-                genre = xml.SubElement(bookinfo, "genre")
-                genre.text = comicinfo_tree.find("Genre").text
-
-            if comicinfo_tree.find("Characters") != None:
-              characters = xml.SubElement(bookinfo, "characters")
-              for character in comicinfo_tree.find("Characters").text.split(', '):
-                name = xml.SubElement(characters, "name")
-                name.text = character
-
-            if comicinfo_tree.find("Series") != None:
-              sequence = xml.SubElement(bookinfo, "sequence", title=comicinfo_tree.find("Series").text)
-              if comicinfo_tree.find("Number") != None:
-                sequence.text = comicinfo_tree.find("Number").text
-              else:
-                sequence.text = '0'
-
-            if comicinfo_tree.find("Summary") != None:
-              annotation = xml.SubElement(bookinfo, "annotation")
-              for text_line in comicinfo_tree.find("Summary").text.split("\n"):
-                if text_line != '':
-                  paragraph = xml.SubElement(annotation, "p")
-                  paragraph.text = text_line
-
-            if comicinfo_tree.find("LanguageISO") != None:
-              languages = xml.SubElement(bookinfo, "languages")
-              language = xml.SubElement(languages, "text-layer", lang=comicinfo_tree.find("LanguageISO").text, show="False")
-
-            if comicinfo_tree.find("Year") != None and comicinfo_tree.find("Month") != None and comicinfo_tree.find("Day") != None:
-              publish_date = comicinfo_tree.find("Year").text + "-" + comicinfo_tree.find("Month").text + "-" + comicinfo_tree.find("Day").text
-              publish_date = xml.SubElement(publishinfo, "publish-date", value=publish_date)
-              publish_date.text = comicinfo_tree.find("Year").text
-
-            if comicinfo_tree.find("Publisher") != None:
-             publisher = xml.SubElement(publishinfo, "publisher")
-             publisher.text = comicinfo_tree.find("Publisher").text
-
-          # save generated acbf file
+
+          # generated document is passed in memory, file name only places it into book directory
           return_filename = os.path.join(self.tempdir, os.path.splitext(os.path.basename(self.filename))[0] + '.acbf')
-          f = open(return_filename, 'w')
-          f.write(xml.tostring(tree, encoding='unicode', pretty_print=True))
-          f.close()
+          self._window.prepared_tree = create_acbf_tree(all_files, self.open_member, self.image_size)
+          if index is not None and index.modified:
+            index.save_index()
 
         self._window.prepared_file = return_filename
 
-    def extract_file(self, z, f, prepare_type):
-        z.extract(f, self.tempdir)
-        if prepare_type == 'book':
-          self._window.loading_book_dialog.ids.loading_progress_bar.value = self._window.loading_book_dialog.ids.loading_progress_bar.value + 1
-          #print(self._window.loading_book_dialog.ids.loading_progress_bar.value, '/', self._window.loading_book_dialog.ids.loading_progress_bar.max)
-        #print(f, threading.active_count())
+        if self.archive is not None and self._window.archive is not self.archive:
+          self.archive.close()
+
+    def open_member(self, name):
+      # files of archive kept open are extracted on demand
+      path = os.path.join(self.tempdir, *name.split('/'))
+      if self.archive is not None and name in self.archive.infos and not os.path.isfile(path):
+        path = self.archive.extract(name)
+      if not os.path.isfile(path):
+        return None
+      return open(path, 'rb')
+
+    def image_size(self, name):
+      # read from image header and kept in member index, pages don't need to be extracted for it
+      path = os.path.join(self.tempdir, *name.split('/'))
+      size = None
+      if self.archive is not None and name in self.archive.infos:
+        size = self.archive.image_size(name)
+      elif self.index is not None and name in self.index.image_sizes:
+        size = self.index.image_sizes[name]
+      elif os.path.isfile(path):
+        with open(path, 'rb') as f:
+          size = archive.get_image_size(iter(lambda: f.read(archive.CHUNK_SIZE), b''))
+        if size is not None and self.index is not None and name in self.index.members:
+          self.index.set_image_size(name, size)
+      if size is None:
+        image_file = self.open_member(name)
+        if image_file is None:
+          # page missing from archive and book directory
+          return (0, 0)
+        size = Image.open(image_file).size
+        image_file.close()
+      return size
 
     def show_message_dialog(self, text):
         pass
 
+# function to create ACBF tree for comic book without ACBF file, from list of
+# its files, open_member returns binary file object of a file or None and
+# image_size returns dimensions of an image
+def create_acbf_tree(all_files, open_member, image_size):
+    tree = xml.Element("ACBF", xmlns="http://www.fictionbook-lib.org/xml/acbf/1.0")
+    metadata = xml.SubElement(tree, "meta-data")
+    bookinfo = xml.SubElement(metadata, "book-info")
+    coverpage = xml.SubElement(bookinfo, "coverpage")
+    cover_image = ''
+    files_to_elements = {}
+    publishinfo = xml.SubElement(metadata, "publish-info")
+    docinfo = xml.SubElement(metadata, "document-info")
+    body = xml.SubElement(tree, "body")
+
+    comic_xml = open_member("comic.xml")
+    if comic_xml is not None:
+      is_acv_file = True
+    else:
+      is_acv_file = False
+    comicinfo_xml = open_member("ComicInfo.xml")
+
+    for datafile in sorted(all_files):
+      if datafile[-4:].upper() in ('.JPG', '.PNG', '.GIF', 'WEBP', '.BMP', 'JPEG'):
+        if cover_image == '':
+          # insert coverpage
+          cover_image = xml.SubElement(coverpage, "image", href=datafile)
+          files_to_elements[os.path.basename(datafile)[:-4]] = cover_image
+        else:
+          # insert normal page
+          if is_acv_file and "/" not in datafile:
+            page = xml.SubElement(body, "page")
+            image = xml.SubElement(page, "image", href=datafile)
+            files_to_elements[os.path.basename(datafile)[:-4]] = image
+          elif not is_acv_file:
+            page = xml.SubElement(body, "page")
+            image = xml.SubElement(page, "image", href=datafile)
+
+    # check for ACV's comic.xml
+    if is_acv_file:
+      acv_tree = xml.parse(source = comic_xml)
+
+      if acv_tree.getroot().get("bgcolor") != None:
+        body.set("bgcolor", acv_tree.getroot().get("bgcolor"))
+
+      if acv_tree.getroot().get("title") != None:
+        book_title = xml.SubElement(bookinfo, "book-title")
+        book_title.text = acv_tree.getroot().get("title")
+
+      images = acv_tree.find("images")
+      pattern_length = len(images.get("indexPattern"))
+      pattern_format = images.get("namePattern").replace("@index", "%%0%dd" % pattern_length)
+      for screen in acv_tree.findall("screen"):
+        element = files_to_elements[pattern_format % int(screen.get("index"))]
+        xsize, ysize = image_size(element.get('href'))
+        for frame in screen:
+          x1, y1, w, h = map(float, frame.get("relativeArea").split(" "))
+          ix1 = int(xsize * x1)
+          ix2 = int(xsize * (x1 + w))
+          iy1 = int(ysize * y1)
+          iy2 = int(ysize * (y1 + h))
+          envelope = "%d,%d %d,%d %d,%d %d,%d" % (ix1, iy1, ix2, iy1, ix2, iy2, ix1, iy2)
+          frame_elt = xml.SubElement(element.getparent(), "frame", points=envelope)
+          if frame.get("bgcolor") != None:
+            frame_elt.set("bgcolor", frame.get("bgcolor"))
+
+    # check if there's ComicInfo.xml file inside
+    elif comicinfo_xml is not None:
+      # load comic book information from ComicInfo.xml
+      comicinfo_tree = xml.parse(source = comicinfo_xml)
+
+      for author in ["Writer", "Penciller", "Inker", "Colorist", "CoverArtist", "Adapter", "Letterer"]:
+        if comicinfo_tree.find(author) != None:
+          author_element = xml.SubElement(bookinfo, "author", activity=author)
+          first_name = xml.SubElement(author_element, "first-name")
+          first_name.text = comicinfo_tree.find(author).text.split(' ')[0]
+          if len(comicinfo_tree.find(author).text.split(' ')) > 2:
+            middle_name = xml.SubElement(author_element, "middle-name")
+            middle_name.text = ''
+            for i in range(len(comicinfo_tree.find(author).text.split(' '))):
+              if i > 0 and i < (len(comicinfo_tree.find(author).text.split(' ')) - 1):
+                middle_name.text = middle_name.text + ' ' + comicinfo_tree.find(author).text.split(' ')[i]
+          last_name = xml.SubElement(author_element, "last-name")
+          last_name.text = comicinfo_tree.find(author).text.split(' ')[-1]
+
+      if comicinfo_tree.find("Title") != None:
+        book_title = xml.SubElement(bookinfo, "book-title")
+        book_title.text = comicinfo_tree.find("Title").text
+
+      if comicinfo_tree.find("Genre") != None:
+        for one_genre in comicinfo_tree.find("Genre").text.split(', '):
+          genre = xml.SubElement(bookinfo, "genre")
+          genre.text = comicinfo_tree.find("Genre").text
+
+      if comicinfo_tree.find("Characters") != None:
+        characters = xml.SubElement(bookinfo, "characters")
+        for character in comicinfo_tree.find("Characters").text.split(', '):
+          name = xml.SubElement(characters, "name")
+          name.text = character
+
+      if comicinfo_tree.find("Series") != None:
+        sequence = xml.SubElement(bookinfo, "sequence", title=comicinfo_tree.find("Series").text)
+        if comicinfo_tree.find("Number") != None:
+          sequence.text = comicinfo_tree.find("Number").text
+        else:
+          sequence.text = '0'
+
+      if comicinfo_tree.find("Summary") != None:
+        annotation = xml.SubElement(bookinfo, "annotation")
+        for text_line in comicinfo_tree.find("Summary").text.split("\n"):
+          if text_line != '':
+            paragraph = xml.SubElement(annotation, "p")
+            paragraph.text = text_line
+
+      if comicinfo_tree.find("LanguageISO") != None:
+        languages = xml.SubElement(bookinfo, "languages")
+        language = xml.SubElement(languages, "text-layer", lang=comicinfo_tree.find("LanguageISO").text, show="False")
+
+      if comicinfo_tree.find("Year") != None and comicinfo_tree.find("Month") != None and comicinfo_tree.find("Day") != None:
+        publish_date = comicinfo_tree.find("Year").text + "-" + comicinfo_tree.find("Month").text + "-" + comicinfo_tree.find("Day").text
+        publish_date = xml.SubElement(publishinfo, "publish-date", value=publish_date)
+        publish_date.text = comicinfo_tree.find("Year").text
+
+      if comicinfo_tree.find("Publisher") != None:
+       publisher = xml.SubElement(publishinfo, "publisher")
+       publisher.text = comicinfo_tree.find("Publisher").text
+
+    for member_file in (comic_xml, comicinfo_xml):
+      if member_file is not None:
+        member_file.close()
+    return tree
+
+class FileProbe():
+    """Reads metadata and coverpage of comic book straight from its archive
+    members into memory, used by library import. Nothing is written to disk,
+    so books can be probed in parallel. Formats extracted by patool only are
+    not supported.
+    """
+
+    def __init__(self, filename):
+      self.filename = str(filename)
+      self.base_dir = os.path.dirname(self.filename)
+      self.book_dir = self.base_dir
+      self.archive = None
+      self.prefetcher = None
+      self.acbf_document = None
+      self.cover_data = None
+      self.bad_pages = []
+      self.supported = True
+
+      file_type = None
+      index = None
+      rarfile = None
+      if self.filename[-4:].upper() != 'ACBF':
+        index = archive.MemberIndex(os.path.join(App.get_running_app().user_data_dir, 'Index'), self.filename)
+        file_type = index.file_type
+      if self.filename[-4:].upper() == '.CBR':
+        rarfile = load_unrar()
+      if file_type is None:
+        file_type = get_file_type(self.filename, index, rarfile)
+
+      if file_type != 'ACBF' and not has_member_access(file_type, rarfile):
+        self.supported = False
+        return
+
+      try:
+        if file_type == 'ACBF':
+          self.acbf_document = acbfdocument.ACBFDocument(self, self.filename, probe=True,
+                                                         snapshot_dir=os.path.join(App.get_running_app().user_data_dir, 'Documents'))
+        else:
+          # members are addressed as paths under the archive file, nothing is extracted there
+          self.archive = archive.open_archive(file_type, self.filename, self.filename, index)
+          self.acbf_document = self.load_archive(index)
+          if App.get_running_app().config.get('general', 'verify_pages') == '1':
+            self.bad_pages = check_pages(self.archive, index.pages, os.cpu_count() or 1)
+        if self.acbf_document.valid:
+          self.cover_data = self.acbf_document.load_image_data(self.acbf_document.coverpage_uri)
+      finally:
+        if self.archive is not None:
+          self.archive.close()
+
+    def load_archive(self, index):
+      for name in self.archive.namelist():
+        if name[-4:].upper() == 'ACBF':
+          source = io.BytesIO(self.archive.read(name))
+          return acbfdocument.ACBFDocument(self, self.archive.member_path(name), source=source, probe=True,
+                                           snapshot_dir=os.path.join(App.get_running_app().user_data_dir, 'Documents'))
+
+      # comic book without ACBF file inside
+      tree = create_acbf_tree(index.pages, self.open_member, self.image_size)
+      if index.modified:
+        index.save_index()
+      acbf_name = os.path.splitext(os.path.basename(self.filename))[0] + '.acbf'
+      return acbfdocument.ACBFDocument(self, self.archive.member_path(acbf_name), probe=True, tree=tree)
+
+    def open_member(self, name):
+      if name in self.archive.infos:
+        return io.BytesIO(self.archive.read(name))
+      return None
+
+    def image_size(self, name):
+      size = self.archive.image_size(name)
+      if size is None:
+        image_file = self.open_member(name)
+        if image_file is None:
+          return (0, 0)
+        size = Image.open(image_file).size
+      return size
+
+# function to check pages in archive with pool of workers, returns names of damaged pages
+def check_pages(member_archive, names, workers):
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+      results = executor.map(lambda name: check_page(member_archive, name), names)
+      return [name for name, valid in zip(names, results) if not valid]
+
+# function to check one page, archive reader verifies CRC and image is decoded without keeping it
+def check_page(member_archive, name):
+    try:
+      image = Image.open(io.BytesIO(member_archive.read(name)))
+      image.verify()
+      return True
+    except Exception as inst:
+      print("Damaged page %s: %s" % (name, inst))
+      return False
+
+# function to load unrar library, returns its rarfile module or None
+def load_unrar():
+    for unrar_lib in ['arm64-v8a', 'armeabi-v7a']:
+      lib_path = os.path.join(App.get_running_app().user_data_dir, 'app', 'unrar', unrar_lib, 'libunrardyn.so')
+      os.environ['UNRAR_LIB_PATH'] = lib_path
+      try:
+        from unrar import rarfile
+        return rarfile
+      except Exception as inst:
+        print('Failed to load library: ' + lib_path)
+        print("Exception: %s" % inst)
+    return None
+
+# function to detect type of comic book file, member index of archives is built on the way
+def get_file_type(filename, index, rarfile):
+    if zipfile.is_zipfile(filename):
+      file_type = 'ZIP'
+      with zipfile.ZipFile(filename) as z:
+        index.build(file_type, z.infolist())
+    elif filename[-4:].upper() == 'ACBF':
+      file_type = 'ACBF'
+    elif filename[-4:].upper() == '.CBR':
+      file_type = 'RAR'
+      if rarfile is not None:
+        index.build(file_type, rarfile.RarFile(filename).infolist())
+    elif tarfile.is_tarfile(filename):
+      file_type = 'TAR'
+      index.build(file_type, archive.get_tar_infolist(filename))
+    elif archive.py7zr is not None and archive.py7zr.is_7zfile(filename):
+      file_type = '7Z'
+      index.build(file_type, archive.get_7z_infolist(filename))
+    else:
+      file_type = None
+    return file_type
+
+# function to tell if members of archive can be read one by one in process
+def has_member_access(file_type, rarfile):
+    return file_type in ('ZIP', 'TAR') or (file_type == 'RAR' and rarfile is not None) or (file_type == '7Z' and archive.py7zr is not None)
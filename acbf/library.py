@@ -43,16 +43,22 @@ try:
   from . import constants
   from . import fileprepare
   from . import acbfdocument
+  from . import bookcache
 except Exception:
   import constants
   import fileprepare
   import acbfdocument
+  import bookcache
 
 class Library():
 
   def __init__(self, library_dir):
       self.library_dir = library_dir
       self.prepared_file = None
+      self.prepared_tree = None
+      self.archive = None
+      self.prefetcher = None
+      self.book_dir = library_dir
       self.library_file_path = os.path.join(library_dir, 'library.xml');
       self.load_library()
 
@@ -117,6 +123,15 @@ class Library():
           self.save_library()
       return
 
+  def get_bad_pages(self, path):
+      # pages found damaged when book was imported
+      bad_pages = set()
+      for book in self.tree.findall("book"):
+        if book.get("path") == path:
+          for page in book.findall("bad_pages/page"):
+            bad_pages.add(page.text)
+      return bad_pages
+
   def get_library_info_value(self, element):
       library_info = self.tree.find("library_info")
       if library_info.find(element) != None:
@@ -199,9 +214,9 @@ class Library():
           if book.get("path") == file_uri:
             return
         
-        coverpage, book_title, publish_date, publisher, authors, genres, sequence, annotation, languages, characters, pages, license, has_frames = self.load_file(filename, library_dir)
+        coverpage, book_title, publish_date, publisher, authors, genres, sequence, annotation, languages, characters, pages, license, has_frames, bad_pages = self.load_file(filename, library_dir)
 
-        if book_title == {}:
+        if book_title == {} or book_title is None:
           return False
 
         if file_uri != None:
@@ -256,6 +271,12 @@ class Library():
         new_has_frames = xml.SubElement(new_book, "has_frames")
         new_has_frames.text = str(has_frames)
 
+        if len(bad_pages) > 0:
+          new_bad_pages = xml.SubElement(new_book, "bad_pages")
+          for bad_page in bad_pages:
+            new_bad_page = xml.SubElement(new_bad_pages, "page")
+            new_bad_page.text = bad_page
+
         return True
 
   def convert_webp(self, *args):
@@ -265,20 +286,37 @@ class Library():
 
   def load_file(self, in_filename, library_dir):
         print("library - load_file")
-        fileprepare.FilePrepare(self, in_filename, library_dir, 'lib')
-        self.tempdir = library_dir
-        self.base_dir = os.path.dirname(in_filename)
-        acbf_document = acbfdocument.ACBFDocument(self, self.prepared_file)
+        # metadata and coverpage are read from archive into memory
+        probe = fileprepare.FileProbe(in_filename)
+        if probe.supported:
+          acbf_document = probe.acbf_document
+        else:
+          # books are imported in their own directory, so cached books in temp dir stay
+          import_dir = os.path.join(library_dir, 'Import')
+          if not os.path.exists(import_dir):
+            os.makedirs(import_dir, 0o700)
+          fileprepare.FilePrepare(self, in_filename, import_dir, 'lib')
+          self.tempdir = import_dir
+          self.book_dir = import_dir
+          self.base_dir = os.path.dirname(in_filename)
+          acbf_document = acbfdocument.ACBFDocument(self, self.prepared_file, tree=self.prepared_tree)
         
         if not acbf_document.valid:
-          return None, None, None, None, None, None, None, None, None, None, None, None
+          return None, None, None, None, None, None, None, None, None, None, None, None, None, None
 
         # coverpage
-        self.load_image = acbf_document.coverpage
-        if self.load_image[-4:].upper() == 'WEBP':
-          self.convert_webp()
+        if not probe.supported:
+          self.load_image = acbf_document.coverpage
+          if self.load_image[-4:].upper() == 'WEBP':
+            self.convert_webp()
+          coverpage = Image.open(self.load_image)
+        elif probe.cover_data is not None:
+          coverpage = Image.open(io.BytesIO(probe.cover_data))
+          if coverpage.format == 'WEBP':
+            coverpage = coverpage.convert("RGB")
+        else:
+          coverpage = Image.open('./images/default.png')
 
-        coverpage = Image.open(self.load_image)
         coverpage.thumbnail((int(coverpage.size[0]*300/float(coverpage.size[1])),300), Image.NEAREST)
         output_directory = os.path.join(os.path.join(self.library_dir, 'Covers'), acbf_document.book_title[list(acbf_document.book_title.items())[0][0]][0].upper())
         if not os.path.exists(output_directory):
@@ -321,13 +359,10 @@ class Library():
         languages = languages[:-2]
 
         # clear library temp directory
-        for root, dirs, files in os.walk(library_dir):
-          for f in files:
-            os.unlink(os.path.join(root, f))
-          for d in dirs:
-            shutil.rmtree(os.path.join(root, d))
+        if not probe.supported:
+          bookcache.clear_dir(import_dir)
 
-        return cover_filename, acbf_document.book_title, publish_date, acbf_document.publisher, acbf_document.authors, acbf_document.genres, sequences, acbf_document.annotation, languages, acbf_document.characters, acbf_document.pages_total, acbf_document.license, acbf_document.has_frames
+        return cover_filename, acbf_document.book_title, publish_date, acbf_document.publisher, acbf_document.authors, acbf_document.genres, sequences, acbf_document.annotation, languages, acbf_document.characters, acbf_document.pages_total, acbf_document.license, acbf_document.has_frames, probe.bad_pages
 
 
 # function to retrieve text value from element without throwing exception
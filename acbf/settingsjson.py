@@ -62,12 +62,32 @@ lib_json = json.dumps([
 'desc': 'Lock page when comic is zoomed out showing the whole page.',
 'section': 'general',
 'key': 'lock_page'},
+{'type': 'bool',
+'title': 'Extract Pages on Demand',
+'desc': 'Open comic book archives without unpacking them first, pages are extracted when they are shown.',
+'section': 'general',
+'key': 'lazy_extract'},
+{'type': 'bool',
+'title': 'Verify Pages on Import',
+'desc': 'Check every page of comic books added into library, damaged pages are skipped while reading.',
+'section': 'general',
+'key': 'verify_pages'},
+{'type': 'bool',
+'title': 'Prepare Text Layers',
+'desc': 'Read all text layers of opened comic book in background, so switching language is quick.',
+'section': 'general',
+'key': 'extract_texts'},
 {'type': 'icon_path',
 'title': 'Temporary Directory',
 'desc': 'Path where temporary files are stored.',
 'disabled': True,
 'section': 'general',
 'key': 'temp_dir_path'},
+{'type': 'numeric',
+'title': 'Cache Size',
+'desc': 'Space (in MB) for extracted comic books kept in temporary directory, so recently read books open quickly.',
+'section': 'general',
+'key': 'cache_size'},
 {'type': 'scrolloptions',
 'title': 'Icon Set',
 'desc': 'Icon set to render application icons.',
@@ -103,13 +123,7 @@ lib_json = json.dumps([
 'desc': '(c) 2015-2024 Robert Kubik (https://github.com/ACBF-Advanced-Comic-Book-Format).\n3DGlossy icons created by Aha-Soft (www.aha-soft.com), Creative Commons - Attribution 3.0 United States license.\nClean3D icons created by Mysitemyway.com, Creative Commons - Attribution 4.0 license.\nNuoveXT icons under GNU General Public License.\nRavenna3D icons by Double-J Design (http://www.doublejdesign.co.uk), Creative Common 3.0 Attribution license.',
 'disabled': True,
 'section': 'general',
-'key': 'copyright'},
-{'type': 'string',
-'title': 'Threads',
-'desc': 'Dynamic setting for number of threads for loading files.',
-'disabled': True,
-'section': 'general',
-'key': 'threads'}
+'key': 'copyright'}
 ])
 
 image_json = json.dumps([
@@ -23,10 +23,8 @@ https://github.com/ACBF-Advanced-Comic-Book-Format
 from PIL import Image, ImageOps, ImageDraw, ImageFont, ImageEnhance, ImageChops
 if not hasattr(Image, 'Resampling'): # for older version of Pillow
   Image.Resampling = Image
-from xml.sax.saxutils import unescape
 import math
 from io import StringIO
-import re
 import sys
 import time
 
@@ -37,6 +35,8 @@ except Exception:
   import constants
   import acbfdocument
 
+FONT_STYLES = ('normal', 'emphasis', 'strong', 'code', 'commentary', 'sign', 'formal', 'heading', 'letter', 'audio', 'thought')
+
 class TextLayer():
     
     def __init__(self, filename, page_number, acbf_document, language_layer, output_image,
@@ -48,6 +48,7 @@ class TextLayer():
         self.PILBackgroundImageProcessed = None
         self.text_areas, self.references = acbf_document.load_page_texts(page_number, acbf_document.languages[language_layer][0])
         
+        self.fonts = {}
         self.updated = False
         #print(constants.FONTS_LIST)
         self.normal_font = normal_font
@@ -133,8 +134,27 @@ class TextLayer():
           else:
             return ImageFont.load_default()
 
-    def remove_xml_tags(self, in_string):
-        return unescape(re.sub(u"<[^>]*>", '', in_string.replace('\n', ' ')))
+    def load_fonts(self, height):
+        # style -> (font, small font) for character height, loaded once per height
+        if height not in self.fonts:
+          fonts = {}
+          for style in FONT_STYLES:
+            fonts[style] = (self.load_font(style, height), self.load_font(style, int(height/2)))
+          self.fonts[height] = fonts
+        return self.fonts[height]
+
+    def get_word_length(self, draw, fonts, area_style, word):
+        length = 0
+        for text, flags, link in word[0]:
+          if flags & (acbfdocument.RUN_SUP | acbfdocument.RUN_SUB) or link is not None:
+            font = fonts[get_run_style(area_style, flags)][1]
+          else:
+            font = fonts[get_run_style(area_style, flags)][0]
+          try:
+            length = length + draw.textlength(text=text, font=font)
+          except:
+            length = length + draw.textlength(text=text.encode(encoding='ascii',errors='replace'), font=font)
+        return length
 
     def median(self, lst):
         lst = sorted(lst)
@@ -155,16 +175,17 @@ class TextLayer():
             time.sleep(self._window.conf_anim_dur / 2)
 
           polygon = []
-          text = text_area[1]
+          text = text_area.text
           if len(text) == 0:
             continue
+          points = text_area.points
 
-          if text_area[3] == 0:
+          if text_area.rotation == 0:
             draw = image_draw
-            polygon = text_area[0]
+            polygon = points
           else: # text-area has text-rotation attribute
-            polygon = text_area[0]
-            original_polygon_boundaries = get_frame_span(text_area[0])
+            polygon = points
+            original_polygon_boundaries = text_area.bounds
             original_polygon_size = ((original_polygon_boundaries[2] - original_polygon_boundaries[0]), (original_polygon_boundaries[3] - original_polygon_boundaries[1]))
 
             # move polygon to 0,0
@@ -175,7 +196,7 @@ class TextLayer():
               moved_polygon.append((point[0] - polygon_center_x, point[1] - polygon_center_y))
             
             # rotate polygon
-            rotated_polygon = rotatePolygon(moved_polygon, text_area[3])
+            rotated_polygon = rotatePolygon(moved_polygon, text_area.rotation)
 
             # move polygon to image center
             polygon = []
@@ -191,56 +212,26 @@ class TextLayer():
           polygon_boundaries = get_frame_span(polygon)
 
           # draw text-area background
-          if not text_area[6]:
-            draw.polygon(polygon, fill=text_area[2])
+          if not text_area.transparent:
+            draw.polygon(polygon, fill=text_area.bgcolor)
           
-          # calculate some default values
-          polygon_area = area(polygon)
+          # calculate some default values, rotation keeps area of polygon
+          polygon_area = text_area.area
           
-          if '<COMMENTARY>' in text.upper() or text_area[4].upper() == 'COMMENTARY':
+          words = get_words(text_area.paragraphs)
+          if text_area.type.upper() == 'COMMENTARY' or get_flags(words) & acbfdocument.RUN_COMMENTARY:
             is_commentary = True
+            area_style = 'commentary'
           else:
             is_commentary = False
+            area_style = get_area_style(text_area.type)
 
-          if text_area[4].upper() == 'SIGN':
-            is_sign = True
-          else:
-            is_sign = False
-
-          if text_area[4].upper() == 'FORMAL':
+          if text_area.type.upper() == 'FORMAL':
             is_formal = True
           else:
             is_formal = False
 
-          if text_area[4].upper() == 'HEADING':
-            is_heading = True
-          else:
-            is_heading = False
-
-          if text_area[4].upper() == 'LETTER':
-            is_letter = True
-          else:
-            is_letter = False
-
-          if text_area[4].upper() == 'AUDIO':
-            is_audio = True
-          else:
-            is_audio = False
-
-          if text_area[4].upper() == 'THOUGHT':
-            is_thought = True
-          else:
-            is_thought = False
-
-          if text_area[4].upper() == 'CODE':
-            is_code = True
-          else:
-            is_code = False
-
-          is_emphasis = is_strong = False
-          words = text.replace('a href', 'a_href').replace(' ', ' ˇ').split('ˇ')
-          words_upper = text.replace(' ', 'ˇ').upper().split('ˇ')
-          area_per_character = polygon_area/len(self.remove_xml_tags(text))
+          area_per_character = polygon_area/len(text)
           character_height = int(math.sqrt(area_per_character/2)*2) - 3
 
           # calculate text drawing start
@@ -261,37 +252,12 @@ class TextLayer():
               text_fits = True
               character_height = character_height - 1
               space_between_lines = character_height + character_height * 0.3
-              
-              font = self.load_font('normal', character_height)
-              n_font = self.load_font('normal', character_height)
-              e_font = self.load_font('emphasis', character_height)
-              s_font = self.load_font('strong', character_height)
-              c_font = self.load_font('code', character_height)
-              co_font = self.load_font('commentary', character_height)
-              si_font = self.load_font('sign', character_height)
-              fo_font = self.load_font('formal', character_height)
-              he_font = self.load_font('heading', character_height)
-              le_font = self.load_font('letter', character_height)
-              au_font = self.load_font('audio', character_height)
-              th_font = self.load_font('thought', character_height)
-              n_font_small = self.load_font('normal', int(character_height/2))
-              e_font_small = self.load_font('emphasis', int(character_height/2))
-              s_font_small = self.load_font('strong', int(character_height/2))
-              c_font_small = self.load_font('code', int(character_height/2))
-              co_font_small = self.load_font('commentary', int(character_height/2))
-              si_font_small = self.load_font('sign', int(character_height/2))
-              fo_font_small = self.load_font('formal', int(character_height/2))
-              he_font_small = self.load_font('heading', int(character_height/2))
-              le_font_small = self.load_font('letter', int(character_height/2))
-              au_font_small = self.load_font('audio', int(character_height/2))
-              th_font_small = self.load_font('thought', int(character_height/2))
-
-              use_small_font = False
+              fonts = self.load_fonts(character_height)
 
               drawing_word = 0
               drawing_line = 0
-              lines = [] # (first_word_start, line_text, last_word_end)
-              current_line = ''
+              lines = [] # (first_word_start, line_words, last_word_end)
+              current_line = []
               first_word_start = text_drawing_start
               last_word_end = first_word_start
 
@@ -299,102 +265,7 @@ class TextLayer():
               while drawing_word < len(words):
                 #place first word in line
                 first_word_fits = False
-                tag_split = words[drawing_word].replace('<', 'ˇ<').split('ˇ')
-                chunk_size = 0
-
-                for chunk in tag_split:
-                  chunk_upper = chunk.upper()
-                  if '<SUP>' in chunk_upper or '<SUB>' in chunk_upper or '<A_HREF' in chunk_upper:
-                    use_small_font = True
-                  elif '<EMPHASIS>' in chunk_upper:
-                    is_emphasis = True
-                  elif '<STRONG>' in chunk_upper:
-                    is_strong = True
-                  elif '<CODE>' in chunk_upper or text_area[4].upper() == 'CODE':
-                    is_code = True
-
-                  if is_commentary:
-                    if use_small_font:
-                      font = co_font_small
-                    else:
-                      font = co_font
-
-                  if is_sign:
-                    if use_small_font:
-                      font = si_font_small
-                    else:
-                      font = si_font
-
-                  if is_formal:
-                    if use_small_font:
-                      font = fo_font_small
-                    else:
-                      font = fo_font
-
-                  if is_heading:
-                    if use_small_font:
-                      font = he_font_small
-                    else:
-                      font = he_font
-
-                  if is_letter:
-                    if use_small_font:
-                      font = le_font_small
-                    else:
-                      font = le_font
-
-                  if is_audio:
-                    if use_small_font:
-                      font = au_font_small
-                    else:
-                      font = au_font
-
-                  if is_thought:
-                    if use_small_font:
-                      font = th_font_small
-                    else:
-                      font = th_font
-
-                  if is_code:
-                    if use_small_font:
-                      font = c_font_small
-                    else:
-                      font = c_font
-
-                  if is_emphasis:
-                    if use_small_font:
-                      font = e_font_small
-                    else:
-                      font = e_font
-                  elif is_strong:
-                    if use_small_font:
-                      font = s_font_small
-                    else:
-                      font = s_font
-                  elif is_code:
-                    if use_small_font:
-                      font = c_font_small
-                    else:
-                      font = c_font
-
-                  if '</SUP>' in chunk_upper or '</SUB>' in chunk_upper or '</A>' in chunk_upper:
-                    use_small_font = False
-
-                  if '</EMPHASIS>' in chunk_upper:
-                    is_emphasis = False
-                  elif '</STRONG>' in chunk_upper:
-                    is_strong = False
-                  elif '</CODE>' in chunk_upper:
-                    is_code = False
-
-                  current_chunk = self.remove_xml_tags(chunk)
-                  if current_chunk != '':
-                    try:
-                      chunk_size = chunk_size + draw.textlength(text=current_chunk, font=font)
-                    except:
-                      chunk_size = chunk_size + draw.textlength(text=current_chunk.encode(encoding='ascii',errors='replace'), font=font)
-
-                text_size = (chunk_size, character_height + 1)
+                text_size = (self.get_word_length(draw, fonts, area_style, words[drawing_word]), character_height + 1)
                 
                 while not first_word_fits:
                   # check if text fits
@@ -415,129 +286,30 @@ class TextLayer():
                   else: # move right
                     first_word_start = (first_word_start[0] + 2, first_word_start[1])
 
-                current_line = current_line + words[drawing_word]
+                current_line = current_line + [words[drawing_word]]
                 current_pointer = (first_word_start[0] + text_size[0], first_word_start[1])
                 drawing_word = drawing_word + 1
 
                 #place other words in line that fit
                 other_word_fits = True
                 while other_word_fits and drawing_word < len(words):
-                  tag_split = words[drawing_word].replace('<', 'ˇ<').split('ˇ')
-                  chunk_size = 0
+                  if words[drawing_word][1]: # new paragraph
+                    other_word_fits = False
 
-                  for chunk in tag_split:
-                    chunk_upper = chunk.upper()
-                    if '<BR>' in chunk_upper:
-                      current_chunk = ''
-                      other_word_fits = False
-                    if '<SUP>' in chunk_upper or '<SUB>' in chunk_upper or '<A_HREF' in chunk_upper:
-                      use_small_font = True
-                    elif '<EMPHASIS>' in chunk_upper:
-                      is_emphasis = True
-                    elif '<STRONG>' in chunk_upper:
-                      is_strong = True
-                    elif '<CODE>' in chunk_upper or text_area[4].upper() == 'CODE':
-                      is_code = True
-
-                    if is_commentary:
-                      if use_small_font:
-                        font = co_font_small
-                      else:
-                        font = co_font
-
-                    if is_sign:
-                      if use_small_font:
-                        font = si_font_small
-                      else:
-                        font = si_font
-
-                    if is_formal:
-                      if use_small_font:
-                        font = fo_font_small
-                      else:
-                        font = fo_font
-
-                    if is_heading:
-                      if use_small_font:
-                        font = he_font_small
-                      else:
-                        font = he_font
-
-                    if is_letter:
-                      if use_small_font:
-                        font = le_font_small
-                      else:
-                        font = le_font
-
-                    if is_audio:
-                      if use_small_font:
-                        font = au_font_small
-                      else:
-                        font = au_font
-
-                    if is_thought:
-                      if use_small_font:
-                        font = th_font_small
-                      else:
-                        font = th_font
-
-                    if is_code:
-                      if use_small_font:
-                        font = c_font_small
-                      else:
-                        font = c_font
-
-                    if is_emphasis:
-                      if use_small_font:
-                        font = e_font_small
-                      else:
-                        font = e_font
-                    elif is_strong:
-                      if use_small_font:
-                        font = s_font_small
-                      else:
-                        font = s_font
-                    elif is_code:
-                      if use_small_font:
-                        font = c_font_small
-                      else:
-                        font = c_font
-
-                    if '</SUP>' in chunk_upper or '</SUB>' in chunk_upper or '</A>' in chunk_upper:
-                      use_small_font = False
-
-                    if '</EMPHASIS>' in chunk_upper:
-                      is_emphasis = False
-                    elif '</STRONG>' in chunk_upper:
-                      is_strong = False
-                    elif '</CODE>' in chunk_upper:
-                      is_code = False
-
-                    current_chunk = self.remove_xml_tags(chunk)
-                    if current_chunk != '':
-                      try:
-                        chunk_size = chunk_size + draw.textlength(text=current_chunk, font=font)
-                      except:
-                        chunk_size = chunk_size + draw.textlength(text=current_chunk.encode(encoding='ascii',errors='replace'), font=font)
-
-                  text_size = (chunk_size, character_height + 1)
+                  text_size = (self.get_word_length(draw, fonts, area_style, words[drawing_word]), character_height + 1)
                   upper_right_corner_fits = point_inside_polygon(current_pointer[0] + text_size[0], current_pointer[1], polygon)
                   lower_right_corner_fits = point_inside_polygon(current_pointer[0] + text_size[0], current_pointer[1] + text_size[1], polygon)
 
                   if other_word_fits and upper_right_corner_fits and lower_right_corner_fits:
                     diff_ratio = (get_frame_span(polygon)[3] - (current_pointer[1] + text_size[1])) / float(text_size[1])
                     if drawing_word == len(words) - 1 and diff_ratio > 1.45 and not is_formal and not is_commentary:
-                      #print words[drawing_word].encode("ascii","ignore")
-                      #print 'word y:', current_pointer[1] + text_size[1], current_pointer[1] + text_size[1]+ text_size[1]
-                      #print 'polygon:', get_frame_span(polygon)
-                      #print 'diff:', get_frame_span(polygon)[3] - (current_pointer[1] + text_size[1]), diff_ratio
                       other_word_fits = False
                       last_word_end = (current_pointer[0], current_pointer[1] + text_size[1])
                       lines.append((first_word_start, current_line, last_word_end))
-                      current_line = ''
+                      current_line = []
                       first_word_start = (polygon_x_min + 2, first_word_start[1] + space_between_lines)
                     else:
-                      current_line = current_line + words[drawing_word]
+                      current_line = current_line + [words[drawing_word]]
                       #draw.rectangle((current_pointer[0], current_pointer[1], current_pointer[0] + text_size[0], current_pointer[1] + text_size[1]), outline='#ff0000')
                       current_pointer = (current_pointer[0] + text_size[0], current_pointer[1])
                       drawing_word = drawing_word + 1
@@ -545,7 +317,7 @@ class TextLayer():
                     other_word_fits = False
                     last_word_end = (current_pointer[0], current_pointer[1] + text_size[1])
                     lines.append((first_word_start, current_line, last_word_end))
-                    current_line = ''
+                    current_line = []
                     first_word_start = (polygon_x_min + 2, first_word_start[1] + space_between_lines)
 
               last_word_end = (current_pointer[0], current_pointer[1] + text_size[1])
@@ -557,28 +329,19 @@ class TextLayer():
           while self._window.is_animating:
             time.sleep(self._window.conf_anim_dur / 2)
 
-          if '<CODE>' in lines[0][1].upper() or text_area[4].upper() == 'CODE':
-            text_areas_draw.append((character_height, lines, 'CODE', text_area[3], text_area[0], text_area[4], text_area[5]))
-          elif '<COMMENTARY>' in lines[0][1].upper() or text_area[4].upper() == 'COMMENTARY':
-            text_areas_draw.append((character_height, lines, 'COMMENTARY', text_area[3], text_area[0], text_area[4], text_area[5]))
-          elif text_area[4].upper() == 'SIGN':
-            text_areas_draw.append((character_height, lines, 'SIGN', text_area[3], text_area[0], text_area[4], text_area[5]))
-          elif text_area[4].upper() == 'FORMAL':
-            text_areas_draw.append((character_height, lines, 'FORMAL', text_area[3], text_area[0], text_area[4], text_area[5]))
-          elif text_area[4].upper() == 'HEADING':
-            text_areas_draw.append((character_height, lines, 'HEADING', text_area[3], text_area[0], text_area[4], text_area[5]))
-          elif text_area[4].upper() == 'LETTER':
-            text_areas_draw.append((character_height, lines, 'LETTER', text_area[3], text_area[0], text_area[4], text_area[5]))
-          elif text_area[4].upper() == 'AUDIO':
-            text_areas_draw.append((character_height, lines, 'AUDIO', text_area[3], text_area[0], text_area[4], text_area[5]))
-          elif text_area[4].upper() == 'THOUGHT':
-            text_areas_draw.append((character_height, lines, 'THOUGHT', text_area[3], text_area[0], text_area[4], text_area[5]))
-          else:
-            text_areas_draw.append((character_height, lines, 'SPEECH', text_area[3], text_area[0], text_area[4], text_area[5]))
+          first_line_flags = get_flags(lines[0][1])
+          area_type = text_area.type.upper()
+          if first_line_flags & acbfdocument.RUN_CODE or area_type == 'CODE':
+            area_type = 'CODE'
+          elif first_line_flags & acbfdocument.RUN_COMMENTARY or area_type == 'COMMENTARY':
+            area_type = 'COMMENTARY'
+          elif area_type not in ('SIGN', 'FORMAL', 'HEADING', 'LETTER', 'AUDIO', 'THOUGHT'):
+            area_type = 'SPEECH'
+          text_areas_draw.append((character_height, lines, area_type, text_area.rotation, points, text_area.type, text_area.inverted))
 
           # rotate image back to original rotation after text is drawn
-          if text_area[3] != 0:
-            draw_image = draw_image.rotate(text_area[3], Image.Resampling.BILINEAR, 1)
+          if text_area.rotation != 0:
+            draw_image = draw_image.rotate(text_area.rotation, Image.Resampling.BILINEAR, 1)
             rotated_image_size = draw_image.size
             left = (rotated_image_size[0] - original_polygon_size[0])/2
             upper = (rotated_image_size[1] - original_polygon_size[1])/2
@@ -690,181 +453,16 @@ class TextLayer():
             while self._window.is_animating:
               time.sleep(self._window.conf_anim_dur / 2)
             current_character_height = normalized_character_height
-            font = self.load_font('normal', current_character_height)
-            n_font = self.load_font('normal', current_character_height)
-            e_font = self.load_font('emphasis', current_character_height)
-            s_font = self.load_font('strong', current_character_height)
-            c_font = self.load_font('code', current_character_height)
-            co_font = self.load_font('commentary', current_character_height)
-            si_font = self.load_font('sign', current_character_height)
-            fo_font = self.load_font('formal', current_character_height)
-            he_font = self.load_font('heading', current_character_height)
-            le_font = self.load_font('letter', current_character_height)
-            au_font = self.load_font('audio', current_character_height)
-            th_font = self.load_font('thought', current_character_height)
-            n_font_small = self.load_font('normal', int(current_character_height/2))
-            e_font_small = self.load_font('emphasis', int(current_character_height/2))
-            s_font_small = self.load_font('strong', int(current_character_height/2))
-            c_font_small = self.load_font('code', int(current_character_height/2))
-            co_font_small = self.load_font('commentary', int(current_character_height/2))
-            si_font_small = self.load_font('sign', int(current_character_height/2))
-            fo_font_small = self.load_font('formal', int(current_character_height/2))
-            he_font_small = self.load_font('heading', int(current_character_height/2))
-            le_font_small = self.load_font('letter', int(current_character_height/2))
-            au_font_small = self.load_font('audio', int(current_character_height/2))
-            th_font_small = self.load_font('thought', int(current_character_height/2))
+            fonts = self.load_fonts(current_character_height)
+          area_style = get_area_style(text_area[2])
 
           # calculate new line length
           if normalized_character_height != text_area[0]:
             #print "normalized", text_area[0], normalized_character_height, text_area[1]
             for line in text_area[1]:
-              # calculate some default values
-              text = line[1]
-              if '<COMMENTARY>' in text.upper() or text_area[2] == 'COMMENTARY':
-                is_commentary = True
-              else:
-                is_commentary = False
-
-              if text_area[2] == 'SIGN':
-                is_sign = True
-              else:
-                is_sign = False
-
-              if text_area[2] == 'FORMAL':
-                is_formal = True
-              else:
-                is_formal = False
-
-              if text_area[2] == 'HEADING':
-                is_heading = True
-              else:
-                is_heading = False
-
-              if text_area[2] == 'LETTER':
-                is_letter = True
-              else:
-                is_letter = False
-
-              if text_area[2] == 'AUDIO':
-                is_audio = True
-              else:
-                is_audio = False
-
-              if text_area[2] == 'THOUGHT':
-                is_thought = True
-              else:
-                is_thought = False
-
-              if text_area[2] == 'CODE':
-                is_code = True
-              else:
-                is_code = False
-
-              is_emphasis = is_strong = False
-              words = text.replace('a href', 'a_href').replace(' ', ' ˇ').split('ˇ')
-              words_upper = text.replace(' ', 'ˇ').upper().split('ˇ')
-              drawing_word = 0
               line_length = 0
-
-              while drawing_word < len(words):
-                tag_split = words[drawing_word].replace('<', 'ˇ<').split('ˇ')
-                chunk_size = 0
-
-                for chunk in tag_split:
-                  chunk_upper = chunk.upper()
-                  if '<BR>' in chunk_upper:
-                    current_chunk = ''
-                  if '<SUP>' in chunk_upper or '<SUB>' in chunk_upper or '<A_HREF' in chunk_upper:
-                    use_small_font = True
-                  elif '<EMPHASIS>' in chunk_upper:
-                    is_emphasis = True
-                  elif '<STRONG>' in chunk_upper:
-                    is_strong = True
-                  elif '<CODE>' in chunk_upper:
-                    is_code = True
-
-                  if is_commentary:
-                    if use_small_font:
-                      font = co_font_small
-                    else:
-                      font = co_font
-
-                  if is_sign:
-                    if use_small_font:
-                      font = si_font_small
-                    else:
-                      font = si_font
-
-                  if is_formal:
-                    if use_small_font:
-                      font = fo_font_small
-                    else:
-                      font = fo_font
-
-                  if is_heading:
-                    if use_small_font:
-                      font = he_font_small
-                    else:
-                      font = he_font
-
-                  if is_letter:
-                    if use_small_font:
-                      font = le_font_small
-                    else:
-                      font = le_font
-
-                  if is_audio:
-                    if use_small_font:
-                      font = au_font_small
-                    else:
-                      font = au_font
-
-                  if is_thought:
-                    if use_small_font:
-                      font = th_font_small
-                    else:
-                      font = th_font
-
-                  if is_code:
-                    if use_small_font:
-                      font = c_font_small
-                    else:
-                      font = c_font
-
-                  if is_emphasis:
-                    if use_small_font:
-                      font = e_font_small
-                    else:
-                      font = e_font
-                  elif is_strong:
-                    if use_small_font:
-                      font = s_font_small
-                    else:
-                      font = s_font
-                  elif is_code:
-                    if use_small_font:
-                      font = c_font_small
-                    else:
-                      font = c_font
-
-                  if '</SUP>' in chunk_upper or '</SUB>' in chunk_upper or '</A>' in chunk_upper:
-                    use_small_font = False
-
-                  if '</EMPHASIS>' in chunk_upper:
-                    is_emphasis = False
-                  elif '</STRONG>' in chunk_upper:
-                    is_strong = False
-                  elif '</CODE>' in chunk_upper:
-                    is_code = False
-
-                  current_chunk = self.remove_xml_tags(chunk)
-                  if current_chunk != '':
-                    try:
-                      chunk_size = chunk_size + draw.textlength(text=current_chunk, font=font)
-                    except:
-                      chunk_size = chunk_size + draw.textlength(text=current_chunk.encode(encoding='ascii',errors='replace'), font=font)
-                drawing_word = drawing_word + 1
-                line_length = line_length + chunk_size
+              for word in line[1]:
+                line_length = line_length + self.get_word_length(draw, fonts, area_style, word)
               change_in_height = int(round((((line[2][1] - line[0][1]) - (current_character_height + 1)) / 2), 0))
               lines.append(((line[0][0], line[0][1] - change_in_height), line[1], (line[0][0] + line_length, line[0][1] + current_character_height + 1 - change_in_height)))
           else:
@@ -921,96 +519,15 @@ class TextLayer():
                   #draw.rectangle((min_coordinate + 2, line[0][1] + vertical_move, line[2][0] - (line[0][0] - min_coordinate), line[2][1] + vertical_move), outline="#FF0000")
 
 
-          if '<COMMENTARY>' in lines[0][1].upper() or text_area[2] == 'COMMENTARY':
+          if text_area[2] == 'COMMENTARY':
             is_commentary = True
           else:
             is_commentary = False
 
-          if text_area[2] == 'SIGN':
-            is_sign = True
-          else:
-            is_sign = False
-
-          if text_area[2] == 'FORMAL':
-            is_formal = True
-          else:
-            is_formal = False
-
-          if text_area[2] == 'HEADING':
-            is_heading = True
-          else:
-            is_heading = False
-
-          if text_area[2] == 'LETTER':
-            is_letter = True
-          else:
-            is_letter = False
-
-          if text_area[2] == 'AUDIO':
-            is_audio = True
-          else:
-            is_audio = False
-
-          if text_area[2] == 'THOUGHT':
-            is_thought = True
-          else:
-            is_thought = False
-
-          if text_area[2] == 'CODE':
-            is_code = True
-          else:
-            is_code = False
-
           #drawing
-          font = n_font
-          font_small = n_font_small
-          font_color = self.font_color_default
-          strikethrough_word = False
-          use_small_font = False
-          use_superscript = False
-          use_subscript = False
-
-          if is_commentary:
-            font = co_font
-            font_small = co_font_small
-            font_color = self._window.acbf_document.font_colors['commentary']
-          elif is_sign:
-            font = si_font
-            font_small = si_font_small
-            font_color = self._window.acbf_document.font_colors['sign']
-          elif is_formal:
-            font = fo_font
-            font_small = fo_font_small
-            font_color = self._window.acbf_document.font_colors['formal']
-          elif is_heading:
-            font = he_font
-            font_small = he_font_small
-            font_color = self._window.acbf_document.font_colors['heading']
-          elif is_letter:
-            font = le_font
-            font_small = le_font_small
-            font_color = self._window.acbf_document.font_colors['letter']
-          elif is_audio:
-            font = au_font
-            font_small = au_font_small
-            font_color = self._window.acbf_document.font_colors['audio']
-          elif is_thought:
-            font = th_font
-            font_small = th_font_small
-            font_color = self._window.acbf_document.font_colors['thought']
-          elif is_code:
-            font = c_font
-            font_small = c_font_small
-            font_color = self._window.acbf_document.font_colors['code']
-
-          # idetify last line in paragraph
-          for idx, line in enumerate(lines):
-            if '<BR>' in line[1]:
-              lines[idx] = (line[0], line[1].replace('<BR>', ''), line[2])
-              lines[idx-1] = (lines[idx-1][0], '<BR>' + lines[idx-1][1], lines[idx-1][2])
-          
           for idx, line in enumerate(lines):
-            is_last_line = False
+            # line before one that starts new paragraph is last in paragraph
+            is_last_line = idx + 1 < len(lines) and len(lines[idx + 1][1]) > 0 and lines[idx + 1][1][0][1]
             old_line = ''
             while self._window.is_animating:
               time.sleep(self._window.conf_anim_dur / 2)
@@ -1029,86 +546,22 @@ class TextLayer():
                 max_coordinate_set = True
               current_coordinate = current_coordinate + 2
 
-            # split by tags
-            tag_split = line[1].split('<')
-            for i in range(len(tag_split)):
-              if i > 0:
-                tag_split[i] = '<' + tag_split[i]
-
-            for chunk in tag_split:
-              chunk_upper = chunk.upper()
+            for current_word, flags, link in get_chunks(line[1]):
+              style = get_run_style(area_style, flags)
+              font = fonts[style][0]
+              font_small = fonts[style][1]
+              use_subscript = flags & acbfdocument.RUN_SUB != 0
+              use_superscript = flags & acbfdocument.RUN_SUP != 0 or link is not None
+              use_small_font = use_subscript or use_superscript
+              strikethrough_word = flags & acbfdocument.RUN_STRIKETHROUGH != 0
 
-              if '<BR>' in chunk_upper:
-                is_last_line = True
-
-              if '<INVERTED>' in chunk_upper or text_area[6]:
+              if text_area[6] or flags & acbfdocument.RUN_INVERTED:
                 font_color = self.font_color_inverted
-                text_area = (text_area[0], text_area[1], text_area[2], text_area[3], text_area[4], text_area[5], True)
-              elif '</INVERTED>' in chunk_upper:
-                font_color = self._window.acbf_document.font_colors[text_area[2].lower()]
-              elif not text_area[6]:
+              else:
                 font_color = self._window.acbf_document.font_colors[text_area[2].lower()]
-
-              if '<EMPHASIS>' in chunk_upper:
-                font = e_font
-                font_small = e_font_small
-              elif '<STRONG>' in chunk_upper:
-                font = s_font
-                font_small = s_font_small
-              elif '<CODE>' in chunk_upper:
-                font = c_font
-                font_small = c_font_small
-              elif '<STRIKETHROUGH>' in chunk_upper:
-                strikethrough_word = True
-              elif '</EMPHASIS>' in chunk_upper or '</STRONG>' in chunk_upper or '</CODE>' in chunk_upper:
-                if is_commentary:
-                  font = co_font
-                  font_small = co_font_small
-                elif is_sign:
-                  font = si_font
-                  font_small = si_font_small
-                elif is_formal:
-                  font = fo_font
-                  font_small = fo_font_small
-                elif is_heading:
-                  font = he_font
-                  font_small = he_font_small
-                elif is_letter:
-                  font = le_font
-                  font_small = le_font_small
-                elif is_audio:
-                  font = au_font
-                  font_small = au_font_small
-                elif is_thought:
-                  font = th_font
-                  font_small = th_font_small
-                elif is_code:
-                  font = c_font
-                  font_small = c_font_small
-                else:
-                  font = n_font
-                  font_small = n_font_small
-              elif '</STRIKETHROUGH>' in chunk_upper:
-                strikethrough_word = False
-              elif '</SUP>' in chunk_upper:
-                use_superscript = False
-                use_small_font = False
-              elif '</SUB>' in chunk_upper:
-                use_subscript = False
-                use_small_font = False
-              elif '</A>' in chunk_upper:
-                use_small_font = False
-              elif '<SUP>' in chunk_upper or '<A_HREF' in chunk_upper:
-                use_small_font = True
-                use_superscript = True
-              elif '<SUB>' in chunk_upper:
-                use_small_font = True
-                use_subscript = True
-
               if len(font_color) == 13:
                 font_color = '#' + font_color[1:3] + font_color[5:7] + font_color[9:11]
 
-              current_word = self.remove_xml_tags(chunk)
               if current_word == '':
                 continue
 
@@ -1118,7 +571,7 @@ class TextLayer():
                 if is_commentary or (text_area[5].upper() == 'FORMAL' and idx + 1 == len(lines)): #left align
                   space_between_words = draw.textlength(' ', font=font)
                 elif text_area[5].upper() == 'FORMAL': #justify
-                  w_count = len(line[1].strip().split(' ')) - 1
+                  w_count = len(line[1]) - 1
                   if is_last_line:
                     justify_space = 0
                   elif w_count > 0:
@@ -1158,11 +611,9 @@ class TextLayer():
                 elif use_superscript:
                   draw.text(current_pointer, current_word, font=font_small, fill=font_color)
                   #draw.rectangle((current_pointer[0] - 1, current_pointer[1] - 1, current_pointer[0] + draw.textlength(current_word, font=font_small) + 1, current_pointer[1] + int(character_height * 0.7) + 1), outline=font_color)
-                  if '<A_HREF' in chunk_upper:
-                    reference_id = re.sub("[^#]*#", '', chunk)
-                    reference_id = re.sub("\".*", '', reference_id)
+                  if link is not None:
                     for idxr, reference in enumerate(self.references):
-                      if reference_id == reference[0]:
+                      if link == reference[0]:
                         rectangle = [(current_pointer[0] - 5, current_pointer[1] - 5),
                                      (current_pointer[0] + draw.textlength(current_word, font=font_small) + 5, current_pointer[1] - 5),
                                      (current_pointer[0] + draw.textlength(current_word, font=font_small) + 5, current_pointer[1] + int(current_character_height * 0.7) + 5),
@@ -1201,7 +652,7 @@ class TextLayer():
                     continue
                   if one_word[0].upper() == 'J' and text_area[5].upper() != 'FORMAL': #dirty fix
                     current_pointer = (current_pointer[0] + 1, current_pointer[1])
-                  elif font == e_font or font == s_font:
+                  elif style == 'emphasis' or style == 'strong':
                     current_pointer = (current_pointer[0] - 1, current_pointer[1])
                   draw.text(current_pointer, one_word + ' ', font=font, fill=font_color)
                   word_length = max(draw.textlength(one_word.strip(), font=font) + one_space, draw.textlength(one_word.strip() + ' ', font=font))
@@ -1211,7 +662,7 @@ class TextLayer():
                   current_pointer = (current_pointer[0] + word_length, current_pointer[1])
                   if one_word[-1].upper() == 'J' and text_area[5].upper() != 'FORMAL': #dirty fix:
                     current_pointer = (current_pointer[0] + 1, current_pointer[1])
-                  elif font == e_font or font == s_font:
+                  elif style == 'emphasis' or style == 'strong':
                     current_pointer = (current_pointer[0] + 1, current_pointer[1])
 
                 #draw.text(current_pointer, current_word, font=font, fill=font_color)
@@ -1245,6 +696,65 @@ class TextLayer():
         except:
           None
 
+# function to split paragraphs of text area into words, a word is (pieces, starts_paragraph)
+# where pieces are (text, flags, link) and space after word belongs to it
+def get_words(paragraphs):
+    words = []
+    for idx, runs in enumerate(paragraphs):
+      pieces = []
+      starts_paragraph = idx > 0
+      for run in runs:
+        parts = run.text.split(' ')
+        for i, part in enumerate(parts):
+          if i < len(parts) - 1:
+            part = part + ' '
+          if part == '':
+            continue
+          pieces.append((part, run.flags, run.link))
+          if part[-1] == ' ':
+            words.append((pieces, starts_paragraph))
+            pieces = []
+            starts_paragraph = False
+      if len(pieces) > 0:
+        if idx < len(paragraphs) - 1:
+          pieces[-1] = (pieces[-1][0] + ' ', pieces[-1][1], pieces[-1][2])
+        words.append((pieces, starts_paragraph))
+    return words
+
+# function to join pieces of words in line into chunks of text with the same style
+def get_chunks(words):
+    chunks = []
+    for pieces, starts_paragraph in words:
+      for text, flags, link in pieces:
+        if len(chunks) > 0 and chunks[-1][1] == flags and chunks[-1][2] == link:
+          chunks[-1] = (chunks[-1][0] + text, flags, link)
+        else:
+          chunks.append((text, flags, link))
+    return chunks
+
+def get_flags(words):
+    flags = 0
+    for pieces, starts_paragraph in words:
+      for piece in pieces:
+        flags = flags | piece[1]
+    return flags
+
+# function to pick font style of text area from its type, speech uses normal font
+def get_area_style(area_type):
+    if area_type.lower() in FONT_STYLES:
+      return area_type.lower()
+    return 'normal'
+
+# function to pick font style of run, inline emphasis, strong and code override text area style
+def get_run_style(area_style, flags):
+    if flags & acbfdocument.RUN_EMPHASIS:
+      return 'emphasis'
+    elif flags & acbfdocument.RUN_STRONG:
+      return 'strong'
+    elif flags & acbfdocument.RUN_CODE:
+      return 'code'
+    return area_style
+
 def get_frame_span(frame_coordinates):
     """returns x_min, y_min, x_max, y_max coordinates of a frame"""
     x_min = 100000000
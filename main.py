@@ -27,6 +27,7 @@ kivy.require('2.1.0')
 
 from kivy.app import App
 from kivy.core.window import Window
+from kivy.graphics.texture import Texture
 from kivy.uix.floatlayout import FloatLayout
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.anchorlayout import AnchorLayout
@@ -59,6 +60,7 @@ from kivy.clock import Clock
 
 from io import StringIO
 import random
+import queue
 import shutil
 import threading
 import time
@@ -67,6 +69,8 @@ from math import hypot
 from xml.sax.saxutils import unescape
 
 from acbf import acbfdocument
+from acbf import archive
+from acbf import bookcache
 from acbf import constants
 from acbf import fileprepare
 from acbf import library
@@ -116,15 +120,17 @@ class ScatterBackGroundImage(FloatLayout):
         print("TEMP DIR: " + self.tempdir)
 
         #clean up temp dir
-        if os.path.isdir(self.tempdir):
-          for root, dirs, files in os.walk(self.tempdir):
-            for f in files:
-              os.unlink(os.path.join(root, f))
-            for d in dirs:
-              shutil.rmtree(os.path.join(root, d))
+        bookcache.clear_temp_dir(self.tempdir)
+        self.book_dir = self.tempdir
 
         self.config_dir = config_dir
         self.prepared_file = None
+        self.prepared_tree = None
+        self.bad_pages = set()
+        self.archive = None
+        self.prefetcher = None
+        self.acbf_document = None
+        self.loading_progress = queue.Queue()
         self.is_converting = False
         self.is_animating = False
         self.image_resize_ratio = 1
@@ -424,8 +430,14 @@ class ScatterBackGroundImage(FloatLayout):
     def resize_source_image(self, *args):
         print("resize_source_image")
         self.image_resize_ratio = float(self.MAX_TEXTURE_SIZE) / float(max(self.ids.bg_image.size[0], self.ids.bg_image.size[1]))
-        im = pil_image.open(self.load_image)
+        # page of book kept open may not be extracted
+        if self.archive is not None:
+          image_file = self.archive.open_path(self.load_image)
+        else:
+          image_file = open(self.load_image, 'rb')
+        im = pil_image.open(image_file)
         im.thumbnail([self.MAX_TEXTURE_SIZE, self.MAX_TEXTURE_SIZE], self.conf_resize_filter)
+        image_file.close()
         self.load_image = os.path.join(self.tempdir, 'temp_resized.jpg')
         try:
           im.save(self.load_image, "JPEG")
@@ -471,26 +483,14 @@ class ScatterBackGroundImage(FloatLayout):
             EventLoop.idle()
         elif (self.page_transition == 'UNDEFINED' and self.conf_transition == 'Blend') or self.page_transition == 'BLEND':
           #blend
-          if self.ids.blend_image.source == self.ids.bg_image.source:
-            self.ids.blend_image.reload()
-          else:
-            try:
-              self.ids.blend_image.source = self.ids.bg_image.source
-            except:
-              self.ids.blend_image.source = './images/default.png'
+          self.copy_to_blend_image()
           self.ids.scatter2.scale = self.ids.scatter.scale
           self.ids.scatter2.pos = self.ids.scatter.pos
           self.ids.blend_image.opacity = 1
           self.ids.bg_image.opacity = 0
         elif (self.page_transition == 'UNDEFINED' and self.conf_transition == 'Scroll Right') or self.page_transition == 'SCROLL_RIGHT':
           #scroll right
-          if self.ids.blend_image.source == self.ids.bg_image.source:
-            self.ids.blend_image.reload()
-          else:
-            try:
-              self.ids.blend_image.source = self.ids.bg_image.source
-            except:
-              self.ids.blend_image.source = './images/default.png'
+          self.copy_to_blend_image()
           self.ids.scatter2.scale = self.ids.scatter.scale
           self.ids.scatter2.pos = self.ids.scatter.pos
           self.ids.blend_image.opacity = 1
@@ -498,6 +498,19 @@ class ScatterBackGroundImage(FloatLayout):
         else:
           self.ids.bg_image.opacity = 0
 
+    def copy_to_blend_image(self):
+        if self.ids.bg_image.source == '':
+          # page shown from archive has no file to load again
+          self.ids.blend_image.source = ''
+          self.ids.blend_image.texture = self.ids.bg_image.texture
+        elif self.ids.blend_image.source == self.ids.bg_image.source:
+          self.ids.blend_image.reload()
+        else:
+          try:
+            self.ids.blend_image.source = self.ids.bg_image.source
+          except:
+            self.ids.blend_image.source = './images/default.png'
+
     def page_in(self):
         print("page in")
         self.ids.loading_image.opacity = 0
@@ -586,16 +599,20 @@ class ScatterBackGroundImage(FloatLayout):
         print("load_page")
 
         self.image_resize_ratio = 1
+        if self.prefetcher is not None:
+          self.prefetcher.set_page(self.page_number - 1)
         self.frames = self.acbf_document.load_page_frames(self.page_number)
-        self.load_image = str(self.acbf_document.load_page_image(self.page_number)[0])
+        self.load_image = str(self.acbf_document.load_page_image(self.page_number, extract=False)[0])
         self.is_converting = True
 
         if self.load_image != self.cached_image.original_name or self.page_number > self.pages_total:
           self.cached_image.load_current_page()
         self.load_image = self.cached_image.file_name
 
+        if self.cached_image.member_image is not None:
+          self.show_member(self.cached_image.member_image)
         #reload if needed
-        if self.ids.bg_image.source == self.load_image:
+        elif self.ids.bg_image.source == self.load_image:
           self.ids.bg_image.reload()
         else:
           self.ids.bg_image.source = './images/default.png'
@@ -610,10 +627,28 @@ class ScatterBackGroundImage(FloatLayout):
 
         if len(self.frames) == 0:
           self.frames = [([(0,0), (0, self.ids.bg_image.height), (self.ids.bg_image.width, 0), (self.ids.bg_image.width, self.ids.bg_image.height)], '#000000')]
-        self.page_color = self.hex_to_rgb(self.acbf_document.load_page_image(self.page_number)[1])
+        self.page_color = self.hex_to_rgb(self.acbf_document.load_page_image(self.page_number, extract=False)[1])
 
         self.reposition('move')
 
+    def show_member(self, image):
+        # page decoded by CachedImage from mapped archive, only its pixels are uploaded here
+        try:
+          if max(image.size) > self.MAX_TEXTURE_SIZE:
+            # as resize_source_image does for pages loaded from file
+            self.image_resize_ratio = float(self.MAX_TEXTURE_SIZE) / float(max(image.size))
+            image = image.resize((int(image.size[0] * self.image_resize_ratio), int(image.size[1] * self.image_resize_ratio)),
+                                 self.conf_resize_filter)
+          colorfmt = image.mode.lower()
+          texture = Texture.create(size=image.size, colorfmt=colorfmt)
+          texture.blit_buffer(image.tobytes(), colorfmt=colorfmt, bufferfmt='ubyte')
+          texture.flip_vertical()
+          self.ids.bg_image.source = ''
+          self.ids.bg_image.texture = texture
+        except Exception as inst:
+          print("Unable to show page: %s" % inst)
+          self.ids.bg_image.source = './images/default.png'
+
     def slide_to_page(self, value):
         self.no_page_anim = True
         if self.page_number != int(value):
@@ -935,7 +970,7 @@ class ScatterBackGroundImage(FloatLayout):
           
           for f in documentfile.listFiles():
             file_uri = f.getUri()
-            if file_uri.toString()[-4:].upper() == '.CBZ' or file_uri.toString()[-5:].upper() == '.ACBF' or file_uri.toString()[-4:].upper() == '.ACV' or file_uri.toString()[-4:].upper() == '.CBR':
+            if file_uri.toString()[-4:].upper() == '.CBZ' or file_uri.toString()[-5:].upper() == '.ACBF' or file_uri.toString()[-4:].upper() == '.ACV' or file_uri.toString()[-4:].upper() in ('.CBR', '.CBT', '.CB7'):
               for book in self.library.tree.findall("book"):
                 if book.get("path") == file_uri.toString():
                   break
@@ -964,7 +999,7 @@ class ScatterBackGroundImage(FloatLayout):
             for f in files:
               if f == u'default.cbz':
                 break
-              if f[-4:].upper() == '.CBZ' or f[-5:].upper() == '.ACBF' or f[-4:].upper() == '.ACV' or f[-4:].upper() == '.CBR':
+              if f[-4:].upper() == '.CBZ' or f[-5:].upper() == '.ACBF' or f[-4:].upper() == '.ACV' or f[-4:].upper() in ('.CBR', '.CBT', '.CB7'):
                 for book in self.library.tree.findall("book"):
                   if book.get("path") == os.path.join(root, f):
                     break
@@ -1110,8 +1145,10 @@ class ScatterBackGroundImage(FloatLayout):
         self.history.save_history()
 
         self.filename = path
-        
+        self.close_archive()
+
         if scheduled:
+          progress_event = Clock.schedule_interval(self.update_loading_progress, 0.1)
           if platform == 'android':
             cache_dir = SharedStorage().get_cache_dir()
             if cache_dir and os.path.exists(cache_dir): shutil.rmtree(cache_dir)  # cleaning cache
@@ -1124,24 +1161,52 @@ class ScatterBackGroundImage(FloatLayout):
           t.start()
 
           while t.is_alive():
-            time.sleep(0.1)
+            t.join(0.1)
             EventLoop.idle()
+          progress_event.cancel()
           EventLoop.idle()
           
-          # cleaning cache
+          # cleaning cache, unless the book is read from there
           if platform == 'android':
-            if cache_dir and os.path.exists(cache_dir):
+            if cache_dir and os.path.exists(cache_dir) and self.archive is None and not self.prepared_file.startswith(cache_dir):
               shutil.rmtree(cache_dir)
           self.loading_book_dialog.dismiss()
         else:
           fileprepare.FilePrepare(self, self.filename, self.tempdir, 'book')
+          self.update_loading_progress()
           self.loading_book_dialog.dismiss()
 
+    def close_archive(self):
+        # release archive and document of the book being read, prefetcher closes archive when its workers are done
+        if self.acbf_document is not None:
+          self.acbf_document.close()
+        if self.prefetcher is not None:
+          self.prefetcher.stop()
+          self.prefetcher = None
+        elif self.archive is not None:
+          self.archive.close()
+        self.archive = None
+        archive.archive_pool.close()
+
+    def update_loading_progress(self, *args):
+        # drain progress reported by FilePrepare worker threads
+        while True:
+          try:
+            (value, maximum) = self.loading_progress.get_nowait()
+          except queue.Empty:
+            return
+          self.loading_book_dialog.ids.loading_progress_bar.max = maximum
+          self.loading_book_dialog.ids.loading_progress_bar.value = value
+
     def open_book(self, *args):
         print("open_book")
         self.no_page_anim = True
         self.base_dir = os.path.dirname(self.filename)
-        self.acbf_document = acbfdocument.ACBFDocument(self, self.prepared_file)
+        if self.acbf_document is not None:
+          self.acbf_document.close()
+        self.acbf_document = acbfdocument.ACBFDocument(self, self.prepared_file, tree=self.prepared_tree,
+                                                       snapshot_dir=os.path.join(self.config_dir, 'Documents'))
+        self.prepared_tree = None
 
         if self.acbf_document.font_styles['normal'] != '':
           self.normal_font = self.acbf_document.font_styles['normal']
@@ -1176,6 +1241,7 @@ class ScatterBackGroundImage(FloatLayout):
         self.frame_number = 1
 
         (self.page_number, self.frame_number, self.zoom_index, self.language_layer) = self.history.get_book_details(self.filename)
+        self.bad_pages = self.library.get_bad_pages(self.filename)
         if self.conf_zoom_to_frame == '1' and self.acbf_document.has_frames:
           self.zoom_index = 2
         self.zoom_level = self.zoom_list[self.zoom_index]
@@ -1187,17 +1253,19 @@ class ScatterBackGroundImage(FloatLayout):
               self.language_layer = idx
 
         self.ids.slider.value = self.page_number
-        self.load_page()
 
-        threads = int(App.get_running_app().config.get('general', 'threads').split(',')[1])
-        threads_count = int(App.get_running_app().config.get('general', 'threads').split(',')[2])
-        threads_delay = float(0.2)#float(App.get_running_app().config.get('general', 'threads').split(',')[3])
-        thread_setting = 'True,' + str(threads) + ',' + str(threads_count) + ',' + str(round(threads_delay, 1))
-        App.get_running_app().config.set('general', 'threads', thread_setting)
-        App.get_running_app().config.write()
+        if self.conf_extract_texts == '1':
+          self.acbf_document.start_text_extraction()
+
+        # unpack remaining pages in background, starting around the page shown
+        if self.prefetcher is not None:
+          pages = [self.acbf_document.get_page_member(page) for page in range(1, self.pages_total + 2)]
+          self.prefetcher.start(pages, self.page_number - 1)
+
+        self.load_page()
 
         self.body_color = self.hex_to_rgb(self.acbf_document.bg_color)
-        self.page_color = self.hex_to_rgb(self.acbf_document.load_page_image(self.page_number)[1])
+        self.page_color = self.hex_to_rgb(self.acbf_document.load_page_image(self.page_number, extract=False)[1])
         self.frame_color = [0,0,0,1]
         self.reposition('move')
         self.page_in()
@@ -1253,6 +1321,7 @@ class ScatterBackGroundImage(FloatLayout):
         self.conf_zoom_to_frame = App.get_running_app().config.get('general', 'zoom_to_frame')
         self.conf_keep_screen_on = App.get_running_app().config.get('general', 'keep_screen_on')
         self.conf_lock_page = App.get_running_app().config.get('general', 'lock_page')
+        self.conf_extract_texts = App.get_running_app().config.get('general', 'extract_texts')
         self.library_cols = int(App.get_running_app().config.get('general', 'max_covers'))
         self.conf_iconset = App.get_running_app().config.get('general', 'iconset')
         self.set_keep_screen_on(self.conf_keep_screen_on)
@@ -1329,8 +1398,25 @@ class CachedImage(): #cached_image
         self.is_loading =  False
         self.file_name = './images/blank.png'
         self.original_name = './images/blank.png'
+        # stored archive page decoded in background, it is not extracted for display
+        self.member_image = None
         self.cached_file = os.path.join(self._window.tempdir, 'temp_cached.jpg')
 
+    def decode_member(self, name):
+        # decoder reads member in blocks from archive mapping, it is never copied whole
+        member_file = self._window.archive.open_member(name)
+        try:
+          image = pil_image.open(member_file)
+          if image.mode in ('RGB', 'RGBA'):
+            image.load()
+          elif 'A' in image.mode or 'transparency' in image.info:
+            image = image.convert('RGBA')
+          else:
+            image = image.convert('RGB')
+        finally:
+          member_file.close()
+        return image
+
     def load_next_page(self):
         if self._window.page_number < self._window.pages_total + 1:
           self.load_image(self._window.page_number + 1)
@@ -1343,11 +1429,40 @@ class CachedImage(): #cached_image
           time.sleep(0.1)
 
         self.is_loading =  True
+        self.member_image = None
         try:
-          self.original_name = str(self._window.acbf_document.load_page_image(page_number)[0])
+          self.original_name = str(self._window.acbf_document.load_page_image(page_number, extract=False)[0])
         except:
           self.original_name = './images/default.png'
 
+        # pages found damaged when book was imported are not decoded, they are
+        # named as archive members, relative to book directory however book was prepared
+        try:
+          page_name = os.path.relpath(self.original_name, self._window.book_dir).replace(os.sep, '/')
+        except ValueError:
+          # on another drive
+          page_name = None
+        if page_name in self._window.bad_pages:
+          self.original_name = './images/default.png'
+
+        # pages that are converted are decoded straight from archive, others are extracted for display
+        draw_layer = self._window.acbf_document.languages[self._window.language_layer][1] == 'TRUE'
+        page_source = self.original_name
+        if self._window.archive is not None and self.original_name != './images/default.png':
+          name = self._window.archive.member_name(self.original_name)
+          if self.original_name[-4:].upper() in ('WEBP', '.GIF') or draw_layer:
+            page_source = self._window.archive.open_path(self.original_name)
+          elif name in self._window.archive.infos and self._window.archive.is_stored(name) and not os.path.isfile(self.original_name):
+            # decoded here straight from mapped archive, load_page only uploads pixels
+            try:
+              self.member_image = self.decode_member(name)
+            except Exception as inst:
+              print("Unable to decode page: %s" % inst)
+              self.original_name = './images/default.png'
+          else:
+            self.original_name = self._window.archive.extract_path(self.original_name)
+            page_source = self.original_name
+
         if self.cached_file == os.path.join(self._window.tempdir, 'temp_cached.jpg'):
           self.cached_file = os.path.join(self._window.tempdir, 'temp_cached1.jpg')
         else:
@@ -1358,24 +1473,28 @@ class CachedImage(): #cached_image
         # WebP conversion
         if self.original_name[-4:].upper() == 'WEBP':
           print("Cache: webp conversion")
-          im = pil_image.open(self.original_name).convert("RGB")
+          im = pil_image.open(page_source).convert("RGB")
           self.file_name = self.cached_file
           im.save(self.file_name,"jpeg")
 
         # GIF conversion
         elif self.original_name[-4:].upper() == '.GIF':
           print("Cache: gif conversion")
-          image = pil_image.open(self.original_name)
+          image = pil_image.open(page_source)
           self.file_name = self.cached_file
           image.convert('RGB').save(self.file_name.format("RGB"), "JPEG")
         else:
           self.file_name = self.original_name
 
         # draw text layer
-        if self._window.acbf_document.languages[self._window.language_layer][1] == 'TRUE':
+        if draw_layer:
           print("Cache: draw layer")
           output_image = self.cached_file
-          self.text_layer = text_layer.TextLayer(self.file_name, page_number, self._window.acbf_document,
+          if self.file_name == self.original_name:
+            layer_source = page_source
+          else:
+            layer_source = self.file_name
+          self.text_layer = text_layer.TextLayer(layer_source, page_number, self._window.acbf_document,
                                                  self._window.language_layer, output_image, self._window.normal_font,
                                                  self._window.strong_font, self._window.emphasis_font, self._window.code_font,
                                                  self._window.commentary_font, self._window.sign_font, self._window.formal_font,
@@ -1383,6 +1502,8 @@ class CachedImage(): #cached_image
                                                  self._window.thought_font, self._window)
           self.file_name = output_image
 
+        if page_source is not self.original_name:
+          page_source.close()
         self.is_loading =  False
 
 # Scollable Options override
@@ -1587,19 +1708,12 @@ class ACBFaApp(App):
 
     def tmp_cleanup(self):
         print("Cleanup")
-        # clear temp directory
-        for root, dirs, files in os.walk(self.tempdir):
-          for f in files:
-            os.unlink(os.path.join(root, f))
-          for d in dirs:
-            shutil.rmtree(os.path.join(root, d))
+        # clear temp directory, extracted books stay in cache
+        bookcache.clear_temp_dir(self.tempdir)
         
         try:
-          for root, dirs, files in os.walk(self.my_app.tempdir):
-            for f in files:
-              os.unlink(os.path.join(root, f))
-            for d in dirs:
-              shutil.rmtree(os.path.join(root, d))
+          self.my_app.close_archive()
+          bookcache.clear_temp_dir(self.my_app.tempdir)
         except:
           None
 
@@ -1618,11 +1732,14 @@ class ACBFaApp(App):
                            'zoom_to_frame': 1,
                            'keep_screen_on': 0,
                            'lock_page': 1,
+                           'lazy_extract': 1,
+                           'cache_size': 512,
+                           'verify_pages': 0,
+                           'extract_texts': 1,
                            'iconset': 'Default',
                            'max_covers': 6,
                            'version': '',
-                           'copyright': '',
-                           'threads': 'True,30,0,0.2'})
+                           'copyright': ''})
 
         self.normal_font = self.strong_font = self.emphasis_font = self.code_font = self.commentary_font = self.sign_font = self.formal_font = self.heading_font = self.letter_font = self.audio_font = self.thought_font = ''
 
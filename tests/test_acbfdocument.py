@@ -0,0 +1,103 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from acbf import acbfdocument
+
+DOCUMENT = '''<?xml version="1.0" encoding="UTF-8"?>
+<ACBF xmlns="http://www.fictionbook-lib.org/xml/acbf/1.0">
+  <meta-data>
+    <book-info>
+      <book-title>Snapshot</book-title>
+      <coverpage><image href="#cover.png"/></coverpage>
+      <languages><text-layer lang="en" show="True"/></languages>
+    </book-info>
+    <publish-info/>
+    <document-info/>
+  </meta-data>
+  <body>
+    <page>
+      <image href="#cover.png"/>
+      <text-layer lang="en">
+        <text-area points="0,0 10,0 10,10 0,10"><p>Hello <emphasis>world</emphasis></p></text-area>
+        <text-area points="20,20 30,20 30,30" type="code"><p>%s</p></text-area>
+      </text-layer>
+    </page>
+  </body>
+  <data><binary id="cover.png" content-type="image/png">iVBORw0KGgo=</binary></data>
+</ACBF>
+'''
+
+class Window():
+
+  def __init__(self, book_dir):
+      self.book_dir = book_dir
+      self.base_dir = book_dir
+      self.archive = None
+      self.acbf_document = None
+
+def open_document(tmp_path, text='second'):
+    filename = os.path.join(str(tmp_path), 'book.acbf')
+    # unchanged document keeps its modification time
+    if not os.path.isfile(filename) or open(filename).read() != DOCUMENT % text:
+      with open(filename, 'w') as f:
+        f.write(DOCUMENT % text)
+    window = Window(str(tmp_path))
+    document = acbfdocument.ACBFDocument(window, filename, probe=True, snapshot_dir=os.path.join(str(tmp_path), 'Documents'))
+    window.acbf_document = document
+    return document
+
+def get_texts(document):
+    text_areas, references = document.load_page_texts(2, 'en')
+    return [(text_area.text, text_area.type) for text_area in text_areas]
+
+def test_text_areas_survive_snapshot(tmp_path, monkeypatch):
+    document = open_document(tmp_path)
+    assert document.valid
+    assert get_texts(document) == [('Hello world', 'speech'), ('second', 'code')]
+
+    # second open comes from snapshot, document is not parsed again
+    def parse_document(self, data):
+      raise AssertionError("document parsed instead of loaded from snapshot")
+    monkeypatch.setattr(acbfdocument.ACBFDocument, 'parse_document', parse_document)
+    document = open_document(tmp_path)
+    assert document.valid
+    assert get_texts(document) == [('Hello world', 'speech'), ('second', 'code')]
+
+def test_snapshot_of_file_is_found_without_reading_it(tmp_path, monkeypatch):
+    open_document(tmp_path)
+    def get_data_fingerprint(data):
+      raise AssertionError("document on disk hashed")
+    monkeypatch.setattr(acbfdocument.bookcache, 'get_data_fingerprint', get_data_fingerprint)
+    document = open_document(tmp_path)
+    assert os.path.isfile(document.snapshot_path)
+    assert get_texts(document)[0] == ('Hello world', 'speech')
+
+def test_snapshot_follows_edit_of_same_size(tmp_path):
+    document = open_document(tmp_path, 'second')
+    assert get_texts(document)[1] == ('second', 'code')
+
+    document = open_document(tmp_path, 'secomd')
+    assert get_texts(document)[1] == ('secomd', 'code')
+
+def test_close_releases_mapped_document(tmp_path):
+    document = open_document(tmp_path)
+    data = document.data
+    assert not data.closed
+    document.close()
+    assert data.closed
+    assert document.data is None
+    assert document.load_image_data(document.coverpage_uri) is None
+
+def test_binary_cache_stays_in_its_directory(tmp_path):
+    cache_dir = os.path.join(str(tmp_path), 'book', acbfdocument.BINARY_DIR)
+    binaries = {'../../escaped.png': ('image/png', 'iVBORw0KGgo='), 'cover.png': ('image/png', 'iVBORw0KGgo=')}
+    binary_cache = acbfdocument.BinaryCache(binaries, cache_dir, 1024)
+    for binary_id in binaries:
+      path = binary_cache.get_path(binary_id)
+      assert os.path.dirname(path) == cache_dir
+      assert path.endswith('.png')
+      with open(path, 'rb') as f:
+        assert f.read() == b'\x89PNG\r\n\x1a\n'
+    assert not os.path.exists(os.path.join(str(tmp_path), 'escaped.png'))
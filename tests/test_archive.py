@@ -0,0 +1,183 @@
+import io
+import os
+import sys
+import tarfile
+import threading
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from acbf import archive
+
+PAGES = {'pages/001.png': b'\x89PNG\r\n\x1a\n' + b'1' * 100, 'pages/002.png': b'\x89PNG\r\n\x1a\n' + b'2' * 5000}
+
+def write_tar(filename):
+    with tarfile.open(filename, 'w') as t:
+      for name, data in sorted(PAGES.items()):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        t.addfile(info, io.BytesIO(data))
+
+def test_open_cbt(tmp_path):
+    filename = os.path.join(str(tmp_path), 'book.cbt')
+    write_tar(filename)
+    index_dir = os.path.join(str(tmp_path), 'Index')
+    outdir = os.path.join(str(tmp_path), 'book')
+
+    # first open builds and saves member index, second one reads it
+    index = archive.MemberIndex(index_dir, filename)
+    index.build('TAR', archive.get_tar_infolist(filename))
+    assert os.path.isfile(index.index_file_path)
+    index = archive.MemberIndex(index_dir, filename)
+    assert index.valid
+    assert index.file_type == 'TAR'
+    assert index.pages == sorted(PAGES)
+
+    member_archive = archive.open_archive('TAR', filename, outdir, index)
+    try:
+      for name, data in PAGES.items():
+        assert member_archive.read(name) == data
+        with open(member_archive.extract(name), 'rb') as f:
+          assert f.read() == data
+    finally:
+      member_archive.close()
+
+def test_read_cb7_without_writing(tmp_path):
+    if archive.py7zr is None:
+      return
+    filename = os.path.join(str(tmp_path), 'book.cb7')
+    with archive.py7zr.SevenZipFile(filename, 'w') as z:
+      for name, data in sorted(PAGES.items()):
+        z.writestr(data, name)
+
+    # library probe addresses members under the archive file itself
+    member_archive = archive.open_archive('7Z', filename, filename, None)
+    try:
+      for name, data in PAGES.items():
+        assert member_archive.read(name) == data
+    finally:
+      member_archive.close()
+    assert os.listdir(str(tmp_path)) == ['book.cb7']
+
+def test_prefetcher_records_throughput(tmp_path):
+    filename = os.path.join(str(tmp_path), 'book.cbt')
+    write_tar(filename)
+    member_archive = archive.open_archive('TAR', filename, os.path.join(str(tmp_path), 'book'))
+    samples = []
+    prefetcher = archive.PagePrefetcher(member_archive, 2, lambda *sample: samples.append(sample))
+    prefetcher.start([None] + sorted(PAGES), 0)
+    for t in prefetcher.threads:
+      t.join()
+    member_archive.close()
+
+    assert len(samples) == 1
+    assert samples[0][:2] == (sum(len(data) for data in PAGES.values()), len(PAGES))
+
+def test_prefetcher_skips_stored_pages(tmp_path):
+    filename = os.path.join(str(tmp_path), 'book.cbz')
+    with zipfile.ZipFile(filename, 'w') as z:
+      z.writestr('pages/001.png', PAGES['pages/001.png'], zipfile.ZIP_STORED)
+      z.writestr('pages/002.png', PAGES['pages/002.png'], zipfile.ZIP_DEFLATED)
+    outdir = os.path.join(str(tmp_path), 'book')
+    member_archive = archive.open_archive('ZIP', filename, outdir)
+    assert member_archive.is_stored('pages/001.png')
+    assert not member_archive.is_stored('pages/002.png')
+
+    prefetcher = archive.PagePrefetcher(member_archive, 2)
+    prefetcher.start(sorted(PAGES), 0)
+    for t in prefetcher.threads:
+      t.join()
+
+    # stored page is read from mapped archive when shown
+    assert not os.path.exists(member_archive.member_path('pages/001.png'))
+    assert os.path.isfile(member_archive.member_path('pages/002.png'))
+    member_file = member_archive.open_member('pages/001.png')
+    assert bytes(member_file.getbuffer()) == PAGES['pages/001.png']
+    member_file.close()
+    member_archive.close()
+
+def test_prefetcher_extracts_solid_archive_in_one_pass(tmp_path):
+    if archive.py7zr is None:
+      return
+    filename = os.path.join(str(tmp_path), 'book.cb7')
+    with archive.py7zr.SevenZipFile(filename, 'w') as z:
+      for name, data in sorted(PAGES.items()):
+        z.writestr(data, name)
+    member_archive = archive.open_archive('7Z', filename, os.path.join(str(tmp_path), 'book'))
+    assert member_archive.is_solid()
+
+    prefetcher = archive.PagePrefetcher(member_archive, 4)
+    prefetcher.start(sorted(PAGES), 0)
+    assert len(prefetcher.threads) == 1
+    prefetcher.threads[0].join()
+    for name, data in PAGES.items():
+      with open(member_archive.member_path(name), 'rb') as f:
+        assert f.read() == data
+    assert sorted(os.listdir(member_archive.outdir)) == ['pages']
+
+def test_prefetcher_stop_does_not_wait(tmp_path):
+    filename = os.path.join(str(tmp_path), 'book.cbt')
+    write_tar(filename)
+    member_archive = archive.open_archive('TAR', filename, os.path.join(str(tmp_path), 'book'))
+    release = threading.Event()
+    closed = []
+    iter_member = member_archive.iter_member
+    def slow_iter_member(name):
+      release.wait()
+      return iter_member(name)
+    member_archive.iter_member = slow_iter_member
+    member_archive.close = lambda: closed.append(True)
+
+    prefetcher = archive.PagePrefetcher(member_archive, 1)
+    prefetcher.start(sorted(PAGES), 0)
+    threads = prefetcher.threads
+    prefetcher.stop()
+    # worker is still extracting, archive stays open until it is done
+    assert closed == []
+    release.set()
+    for t in threads:
+      t.join()
+    assert closed == [True]
+
+def test_unsafe_member_does_not_fail_extraction(tmp_path):
+    filename = os.path.join(str(tmp_path), 'book.cbz')
+    with zipfile.ZipFile(filename, 'w') as z:
+      z.writestr('pages/001.png', PAGES['pages/001.png'])
+      z.writestr('../escaped/dir/x.jpg', b'x')
+      z.writestr('../x.jpg', b'x')
+    outdir = os.path.join(str(tmp_path), 'book')
+    os.makedirs(outdir)
+
+    index = archive.MemberIndex(os.path.join(str(tmp_path), 'Index'), filename)
+    with zipfile.ZipFile(filename) as z:
+      index.build('ZIP', z.infolist())
+    assert index.pages == ['pages/001.png']
+
+    # no errors, so book is marked complete in cache
+    extractor = archive.ZipExtractor(filename, outdir, 2, index=index)
+    extractor.start(index.namelist())
+    assert extractor.wait() == []
+    assert os.path.isfile(os.path.join(outdir, 'pages', '001.png'))
+    assert not os.path.exists(os.path.join(str(tmp_path), 'escaped'))
+    assert not os.path.exists(os.path.join(str(tmp_path), 'x.jpg'))
+
+    # page path outside book directory is not extracted on demand either
+    member_archive = archive.open_archive('ZIP', filename, outdir, index)
+    assert member_archive.namelist() == ['pages/001.png']
+    path = os.path.join(outdir, '..', 'x.jpg')
+    assert member_archive.extract_path(path) == path
+    member_archive.close()
+
+def test_member_name_xml_cannot_hold_skips_index(tmp_path):
+    filename = os.path.join(str(tmp_path), 'book.cbz')
+    with zipfile.ZipFile(filename, 'w') as z:
+      z.writestr('pages/001.png', PAGES['pages/001.png'])
+      z.writestr('notes\x01.txt', b'x')
+
+    # book opens from archive listing, index is just not saved
+    index = archive.MemberIndex(os.path.join(str(tmp_path), 'Index'), filename)
+    with zipfile.ZipFile(filename) as z:
+      index.build('ZIP', z.infolist())
+    assert index.valid
+    assert index.pages == ['pages/001.png']
+    assert not os.path.exists(index.index_file_path)
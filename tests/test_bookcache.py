@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from acbf import bookcache
+
+def wait_for_reaper():
+    thread = bookcache.reaper.thread
+    if thread is not None:
+      thread.join()
+
+def add_book(book_cache, name, size):
+    book_dir = book_cache.get_book_dir(name)
+    with open(os.path.join(book_dir, 'page.jpg'), 'wb') as f:
+      f.write(b'x' * size)
+    book_cache.set_complete(book_dir)
+    return book_dir
+
+def test_evict_uses_stored_sizes(tmp_path, monkeypatch):
+    book_cache = bookcache.BookCache(str(tmp_path), 2500)
+    books = []
+    for idx in range(3):
+      filename = os.path.join(str(tmp_path), 'book%d.cbz' % idx)
+      with open(filename, 'w') as f:
+        f.write(filename)
+      books.append(add_book(book_cache, filename, 1000))
+      # eviction orders books by directory modification time
+      os.utime(books[-1], (time.time() + idx, time.time() + idx))
+
+    # books stored their sizes when they were completed, nothing is walked
+    def get_dir_size(path):
+      raise AssertionError("cached book walked: %s" % path)
+    monkeypatch.setattr(bookcache, 'get_dir_size', get_dir_size)
+    book_cache.evict([books[0]])
+    wait_for_reaper()
+
+    assert os.path.isdir(books[0])
+    assert not os.path.exists(books[1])
+    assert os.path.isdir(books[2])
+
+def test_book_without_size_is_measured_once(tmp_path):
+    book_cache = bookcache.BookCache(str(tmp_path), 1024 * 1024)
+    book_dir = os.path.join(book_cache.cache_dir, 'book')
+    os.makedirs(book_dir)
+    with open(os.path.join(book_dir, 'page.jpg'), 'wb') as f:
+      f.write(b'x' * 100)
+
+    book_cache.evict([])
+    wait_for_reaper()
+    with open(os.path.join(book_dir, bookcache.SIZE_FILE)) as f:
+      assert int(f.read()) == 100
+
+def test_reaper_stops_on_entry_it_cannot_remove(tmp_path, monkeypatch):
+    trash_dir = os.path.join(str(tmp_path), bookcache.TRASH_DIR_NAME)
+    os.makedirs(trash_dir)
+    stuck = os.path.join(trash_dir, 'stuck')
+    removable = os.path.join(trash_dir, 'removable')
+    for path in (stuck, removable):
+      open(path, 'w').close()
+
+    remove_path = bookcache.remove_path
+    monkeypatch.setattr(bookcache, 'remove_path', lambda path: None if path == stuck else remove_path(path))
+    reaper = bookcache.Reaper()
+    reaper.reap(trash_dir)
+    thread = reaper.thread
+    if thread is not None:
+      thread.join(5)
+      assert not thread.is_alive()
+    assert reaper.thread is None
+    assert os.listdir(trash_dir) == ['stuck']
+
+def test_evict_removes_old_member_indexes(tmp_path):
+    index_dir = os.path.join(str(tmp_path), 'Index')
+    os.makedirs(index_dir)
+    indexes = []
+    for idx in range(3):
+      indexes.append(os.path.join(index_dir, '%d.xml' % idx))
+      with open(indexes[-1], 'wb') as f:
+        f.write(b'x' * 1000)
+      os.utime(indexes[-1], (time.time() + idx, time.time() + idx))
+
+    book_cache = bookcache.BookCache(str(tmp_path), 2500, index_dir)
+    book_cache.evict([])
+    wait_for_reaper()
+    assert [os.path.exists(index) for index in indexes] == [False, True, True]
+
+    # index of the book being opened is kept even when it is the oldest one
+    os.utime(indexes[1], (time.time() - 10, time.time() - 10))
+    book_cache = bookcache.BookCache(str(tmp_path), 1500, index_dir)
+    book_cache.evict([indexes[1]])
+    wait_for_reaper()
+    assert [os.path.exists(index) for index in indexes] == [False, True, False]
+
+def test_clear_empty_dir_deletes_old_trash(tmp_path):
+    path = os.path.join(str(tmp_path), 'probe')
+    os.makedirs(path)
+    trash_dir = os.path.join(str(tmp_path), bookcache.TRASH_DIR_NAME)
+    os.makedirs(os.path.join(trash_dir, 'old'))
+    bookcache.clear_dir(path)
+    wait_for_reaper()
+    assert os.listdir(trash_dir) == []